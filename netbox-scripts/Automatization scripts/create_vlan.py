@@ -1,224 +1,400 @@
-import pynetbox
+import argparse
+import os
 import sys
 sys.path.insert(1, '/home/netbox-scripter/netbox-git')
 import config
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import api_client
+from device_context import DeviceContextResolver
+import pynetbox
 import paramiko
 import time
 import re
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 start_time = time.time()
 
-nb = pynetbox.api(
-    config.netbox_url,
-    private_key_file=config.private_key_file_path_network,
-    token=config.netbox_token
-)
 
-p = 0
-i = 0
+def netbox_client():
+    # клиент нетбокса один на процесс: пул соединений и ключ сессии secretstore переиспользуются всеми вызовами
+    return api_client.netbox(config.netbox_url, config.netbox_token,
+                             private_key_file=config.private_key_file_path_network)
+
+
+nb = netbox_client()
+
+# данные железок (primary ip, vlan группа, логопасс) загружаются пачкой в create_vlan_fun и общие для всех потоков
+contexts = DeviceContextResolver(nb)
+
+# диапазон, в котором ищется свободный vlan
+VLAN_RANGE_FIRST = 600
+VLAN_RANGE_LAST = 1699
 
 # Тут должен быть список сетевых устройств с интерфейсами, где необходимо протащить влан в формате:
 # devices_interfaces = { 'Netbox_Device-name_first': {'Interface1: 'Fa0/1', 'Interface2: 'Fa0/2'},  'Netbox_Device-name_second': {'Interface1: 'Fa0/1', 'Interface2: 'Fa0/2'}}
 devices_interfaces = {
 }
 
-myLists = {"set_vlans{}".format(i): {} for i in range(12)}
+# приглашение cisco: hostname#, hostname>, hostname(config)#, hostname(config-if)# и т.д.
+PROMPT_RE = re.compile(r'([\w.\-/:]+)(\([\w.\-/]+\))?[>#] ?$')
+MORE_RE = re.compile(r'--More--\s*$')
+
+
+class ShellChannel(object):
+    # обертка над invoke_shell() в стиле expect: после каждой команды читаем вывод, пока не появится приглашение железки
+    # раньше после каждой команды стоял слепой time.sleep(1..5) и recv(1000), который обрезал длинный вывод
+    # теперь команда занимает ровно столько, сколько железка на нее отвечает, а вывод забирается целиком
+
+    def __init__(self, channel, timeout=30):
+        self.channel = channel
+        self.timeout = timeout
+        self.channel.settimeout(0.2)
+        # ждем первое приглашение и запоминаем hostname, чтобы дальше не спутать приглашение с текстом в выводе
+        banner = self.read_until_prompt(PROMPT_RE, timeout)
+        hostname = PROMPT_RE.search(banner.rstrip('\r\n').splitlines()[-1]).group(1)
+        self.prompt_re = re.compile(re.escape(hostname) + r'(\([\w.\-/]+\))?[>#] ?$')
+        # приглашение вне режима конфигурации - по нему понимаем, что пачка команд отработала до end
+        self.exec_prompt_re = re.compile(re.escape(hostname) + r'[>#] ?$')
+
+    def read_until_prompt(self, prompt_re, timeout):
+        output = ''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                chunk = self.channel.recv(65535)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise EOFError('SSH channel closed, output: {}'.format(output[-500:]))
+            output += chunk.decode('ascii', errors='ignore')
+            # на случай, если пейджер не отключен
+            if MORE_RE.search(output):
+                output = MORE_RE.sub('', output)
+                self.channel.send(' ')
+                continue
+            last_line = output.rstrip('\r\n').splitlines()[-1] if output.strip() else ''
+            if prompt_re.search(last_line):
+                return output
+        raise TimeoutError('No prompt within {} s, output: {}'.format(timeout, output[-500:]))
+
+    def send(self, command, timeout=None):
+        # отправляет команду и возвращает весь ее вывод (вместе с эхом команды и приглашением)
+        self.channel.send(command.rstrip('\n') + '\n')
+        return self.read_until_prompt(self.prompt_re, timeout or self.timeout)
+
+    def send_config(self, lines, timeout=None):
+        # весь набор изменений одной сессией конфигурации: conf t, команды, end уходят одной записью в канал,
+        # а читаем один раз - до приглашения вне режима конфигурации
+        # возвращает вывод и список строк с ошибками железки (% Invalid input, ERROR: ...)
+        self.channel.send('conf t\n' + ''.join(line + '\n' for line in lines) + 'end\n')
+        output = self.read_until_prompt(self.exec_prompt_re, timeout or self.timeout + len(lines))
+        errors = [line.strip() for line in output.splitlines() if re.match(r'\s*(%|ERROR)', line)]
+        return output, errors
+
+
+def split_interface(interface):
+    # Gi1/0/12 -> ('Gi1/0/', 12); имя без номера на конце -> (имя, None)
+    match = re.match(r'^(.*?)(\d+)$', interface.strip())
+    if match is None:
+        return interface.strip(), None
+    return match.group(1), int(match.group(2))
+
+
+def interface_ranges(interfaces, nxos=False, max_items=5):
+    # группируем порты для interface range: Gi1/0/1, Gi1/0/2, Gi1/0/3, Gi1/0/7 -> 'Gi1/0/1 - 3, Gi1/0/7'
+    # в одной команде interface range ios допускает не больше 5 элементов, поэтому команд может быть несколько
+    # на nx-os диапазон пишется без пробелов: Ethernet1/1-3
+    groups = []
+    for prefix, number in sorted(set(split_interface(interface) for interface in interfaces),
+                                 key=lambda item: (item[0], item[1] if item[1] is not None else -1)):
+        if number is not None and groups and groups[-1][0] == prefix and groups[-1][2] == number - 1:
+            groups[-1][2] = number
+        else:
+            groups.append([prefix, number, number])
+    items = []
+    for prefix, first, last in groups:
+        if first is None:
+            items.append(prefix)
+        elif first == last:
+            items.append('{}{}'.format(prefix, first))
+        else:
+            items.append(('{}{}-{}' if nxos else '{}{} - {}').format(prefix, first, last))
+    return [', '.join(items[start:start + max_items]) for start in range(0, len(items), max_items)]
 
-def delete_vlan(device,vlan_id):
-    nb = pynetbox.api(
-        config.netbox_url,
-        private_key_file=config.private_key_file_path_network,
-        token=config.netbox_token
-    )
 
-    nb_device = nb.dcim.devices.get(name=device)
-    nb_secret = nb.plugins.netbox_secretstore.secrets.get(device=device)
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(
-        hostname=str(nb_device.primary_ip)[:-3:],
-        username=nb_secret.name,
-        password=nb_secret.plaintext,
-        look_for_keys=False,
-        allow_agent=False)
+def build_change_set(vlan_id, interfaces, action, vlan_name=None, nxos=False):
+    # полный набор команд для одной железки: (при необходимости) сам vlan с именем,
+    # затем switchport trunk allowed vlan add/remove сразу на группы портов
+    lines = []
+    if vlan_name is not None:
+        lines += ['vlan {}'.format(vlan_id), 'name {}'.format(vlan_name), 'exit']
+    for interface_range in interface_ranges(interfaces, nxos=nxos):
+        lines += ['interface {}'.format(interface_range) if nxos else 'interface range {}'.format(interface_range),
+                  'switchport trunk allowed vlan {} {}'.format(action, vlan_id),
+                  'exit']
+    return lines
 
-    remove_template = ['switchport trunk allowed vlan remove {}\n']
 
-    with client.invoke_shell() as ssh:
+def short_name(interface):
+    # GigabitEthernet1/0/1, Gi1/0/1 и gi1/0/1 сравниваем как gi1/0/1 (в выводе железки имена сокращены)
+    match = re.match(r'^([A-Za-z]{2})[A-Za-z\-]*\s*(\S+)$', interface.strip())
+    return (match.group(1) + match.group(2)).lower() if match else interface.strip().lower()
 
-        ssh.send('show vlan id {}\n'.format(vlan_id))
-        time.sleep(2)
-        result = ssh.recv(50000).decode('ascii')
-        match = re.search('not found in current VLAN database', result)
 
-        if match == None:
-            vlan_state = ('Данный vlan занят' + device)
-        else:
-            vlan_state = ('Данный vlan свободен ' + device)
-
-            ssh.send('terminal length 0\n')
-            time.sleep(1)
-            ssh.recv(1000)
-
-            ssh.send('conf t\n')
-            time.sleep(1)
-            ssh.recv(1000)
-
-            ssh.send('vlan {}\n'.format(vlan_id))
-            time.sleep(1)
-            ssh.recv(1000)
-
-            ssh.send('show vlan id {}\n'.format(vlan_id))
-            time.sleep(5)
-            result = ssh.recv(50000).decode('ascii')
-            interfaces_summary = re.findall('(\w{2,}\d*/\d*/\d*|\w{2,}/d*\d*|Po\d{1,})',result)
-
-            for interface_number in interfaces_summary:
-                ssh.send('conf t\n')
-                time.sleep(1)
-                ssh.recv(1000)
-
-                ssh.send('Interface {}\n'.format(interface_number))
-                print('Захожу в режим настройки интерфейса {}'.format(interface_number))
-                time.sleep(1)
-                ssh.recv(1000)
-
-                z = ''.join(remove_template)
-                ssh.send(z.format(vlan_id))
-                print((''.join(remove_template)).format(vlan_id))
-                time.sleep(1)
-                ssh.recv(1000)
-
-                ssh.send('end\n')
-                time.sleep(1)
-                ssh.recv(1000)
-            ssh.close()
-
-    return vlan_state
-
-
-def create_vlan(device, vlan_id, vlan_name, int_list):
-    nb = pynetbox.api(
-        config.netbox_url,
-        private_key_file=config.private_key_file_path_network,
-        token=config.netbox_token
-    )
-
-    print('Execute create vlan function with vlan_id ', vlan_id, vlan_name, device)
-    nb_device = nb.dcim.devices.get(name=device)
-    nb_secret = nb.plugins.netbox_secretstore.secrets.get(device=device)
-    vl_gr = nb.ipam.vlan_groups.get(name=device)
-    nb.ipam.vlans.create(group=vl_gr.id, vid=vlan_id,
-                         name=vlan_name, status='active')
-    trunk_template = ['switchport trunk allowed vlan add {}\n']
+def is_nxos(nb_device):
+    return 'nx' in str(nb_device.platform or '').lower()
 
+
+def connect_device(device):
+    # ssh подключение к железке по данным из нетбокса (ip и логопасс из secretstore)
+    # данные берутся из кэша contexts, в нетбокс идем, только если железки в нем нет
+    ctx = contexts.get(device)
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client.connect(
-        hostname=str(nb_device.primary_ip)[:-3:],
-        username=nb_secret.name,
-        password=nb_secret.plaintext,
+        hostname=ctx.host,
+        username=ctx.username,
+        password=ctx.password,
         look_for_keys=False,
         allow_agent=False,
         timeout=90)
-
-    with client.invoke_shell() as ssh:
-        ssh.send('conf t\n')
-        time.sleep(3)
-        ssh.recv(1000)
-
-
-        ssh.send('vlan {}\n'.format(vlan_id))
-        time.sleep(3)
-        ssh.recv(1000)
-
-
-        ssh.send('name {}\n'.format(vlan_name))
-        # print('name {}\n'.format(vlan_name))
-        time.sleep(3)
-        ssh.recv(1000)
-
-
-        ssh.send('end\n')
-        time.sleep(3)
-        ssh.recv(1000)
-
-
-        for interface in int_list:
-            ssh.send('conf t\n')
-            time.sleep(3)
-            ssh.recv(1000)
-
-            ssh.send('Interface {}\n'.format(interface))
-            print('Захожу в режим настройки интерфейса {}'.format(interface))
-            time.sleep(3)
-            ssh.recv(1000)
-
-            x = ''.join(trunk_template)
-            ssh.send(x.format(vlan_id))
-            print('Прописываю vlanID на порту {}'.format(interface))
-            time.sleep(3)
-            ssh.recv(1000)
-
-            ssh.send('end\n')
-            time.sleep(3)
-            ssh.recv(1000)
-
-    create_vlan_state = ('Successfully ' + device)
-    ssh.close()
-
-    return (create_vlan_state)
-
-def create_vlan_fun():
-    p = 0
-    vlan_name = input("Введите имя vlan'a: ")
-    for device,int_number in devices_interfaces.items():
-        vl_gr = nb.ipam.vlan_groups.get(name=device)
-        vlans = nb.ipam.vlans.filter(group_id=vl_gr.id)
-        vlan_list = []
-        for vlan in vlans:
-            vlan_list.append(vlan.vid)
-        myLists['set_vlans{}'.format(p)] = vlan_list
-        p = p + 1
-
-    for i in range(600,1700):
-        vlan_id = i
-        if vlan_id not in myLists['set_vlans0'] and vlan_id not in myLists['set_vlans1'] and vlan_id not in myLists['set_vlans2'] and vlan_id not in myLists['set_vlans3'] and vlan_id not in myLists['set_vlans4'] and vlan_id not in myLists['set_vlans5'] and vlan_id not in myLists['set_vlans6'] and vlan_id not in myLists['set_vlans7'] and vlan_id not in myLists['set_vlans8'] and vlan_id not in myLists['set_vlans9'] and vlan_id not in myLists['set_vlans10']:
-            break
-        else:
+    return ctx.device, client
+
+
+def parse_vlan_list(vlan_list):
+    # '1-5,10,20-22' -> {1, 2, 3, 4, 5, 10, 20, 21, 22}; all - все vlan'ы, none - пусто
+    vlan_list = vlan_list.strip().lower()
+    if vlan_list == 'all':
+        return set(range(1, 4095))
+    vlans = set()
+    if vlan_list == 'none':
+        return vlans
+    for item in vlan_list.split(','):
+        item = item.strip()
+        if '-' in item:
+            first, last = item.split('-', 1)
+            vlans.update(range(int(first), int(last) + 1))
+        elif item.isdigit():
+            vlans.add(int(item))
+    return vlans
+
+
+def vlan_in_database(show_vlan_output):
+    # есть ли vlan в базе железки по выводу show vlan id X
+    # именно база, а не running-config: в режиме vtp server/client vlan'ы живут в vlan.dat и в конфиге их нет
+    return re.search('not found in current VLAN database', show_vlan_output) is None
+
+
+def parse_running_config(running_config):
+    # из running-config: разрешенные vlan'ы каждого транка {интерфейс: set(vid)}
+    # транк без switchport trunk allowed vlan пропускает все vlan'ы
+    # длинный список ios переносит на несколько строк switchport trunk allowed vlan add ...
+    trunks = {}
+    interface = None
+    trunk_mode = False
+    allowed = None
+    for line in running_config.splitlines() + ['!']:
+        line = line.rstrip()
+        if line and not line[0].isspace():
+            if interface is not None and (trunk_mode or allowed is not None):
+                trunks[interface] = allowed if allowed is not None else parse_vlan_list('all')
+            interface, trunk_mode, allowed = None, False, None
+            match = re.match(r'^interface (\S+)', line)
+            if match:
+                interface = match.group(1)
             continue
+        if interface is None:
+            continue
+        line = line.strip()
+        if line == 'switchport mode trunk':
+            trunk_mode = True
+        match = re.match(r'^switchport trunk allowed vlan (add |remove |except )?(\S+)$', line)
+        if match:
+            action, vlan_list = (match.group(1) or '').strip(), parse_vlan_list(match.group(2))
+            if action == 'add':
+                allowed = (allowed or set()) | vlan_list
+            elif action == 'remove':
+                allowed = (allowed if allowed is not None else parse_vlan_list('all')) - vlan_list
+            elif action == 'except':
+                allowed = parse_vlan_list('all') - vlan_list
+            else:
+                allowed = vlan_list
+    return trunks
+
+
+def plan_device(running_config, vlan_exists, vlan_id, int_list):
+    # план изменений для железки по одному снимку running-config, без единого входа в режим конфигурации:
+    # add - нужные порты, на которых vlan'а еще нет; remove - остальные транки, на которых он есть
+    # (как и раньше, с чужих портов vlan снимается, только если его не было в базе железки - vlan_exists
+    # берется из show vlan id, а не из running-config)
+    trunks = parse_running_config(running_config)
+    by_short = {short_name(interface): interface for interface in trunks}
+    targets = set(short_name(interface) for interface in int_list)
+    plan = {'vlan_exists': vlan_exists, 'add': [], 'remove': []}
+    for interface in int_list:
+        current = by_short.get(short_name(interface))
+        if current is None or vlan_id not in trunks[current]:
+            plan['add'].append(interface)
+    if not plan['vlan_exists']:
+        plan['remove'] = sorted(interface for interface, allowed in trunks.items()
+                                if vlan_id in allowed and short_name(interface) not in targets)
+    return plan
+
+
+def verify_device(running_config, vlan_id, int_list, removed):
+    # missing - нужные порты, на которых vlan так и не разрешен; left - порты, с которых он не снялся
+    trunks = {short_name(interface): allowed for interface, allowed in parse_running_config(running_config).items()}
+    missing = [interface for interface in int_list if vlan_id not in trunks.get(short_name(interface), ())]
+    left = [interface for interface in removed if vlan_id in trunks.get(short_name(interface), ())]
+    return missing, left
+
+
+def rollout_device(device, vlan_id, vlan_name, int_list, dry_run=False):
+    # всё по железке идет через ОДНУ ssh сессию: show vlan id и снимок running-config, план,
+    # одна сессия конфигурации, проверка по второму снимку running-config
+    # трогаются только порты, состояние которых отличается от нужного; в dry_run режим конфигурации не открывается
+    # возвращает отчет по железке, ошибки не теряются, а попадают в отчет
+    report = {'device': device, 'plan': None, 'remove': None, 'add': None, 'error': None}
+    started = time.time()
+    try:
+        nb_device, client = connect_device(device)
+        try:
+            with client.invoke_shell() as channel:
+                ssh = ShellChannel(channel)
+                ssh.send('terminal length 0')
+                vlan_exists = vlan_in_database(ssh.send('show vlan id {}'.format(vlan_id)))
+                plan = plan_device(ssh.send('show running-config', timeout=120), vlan_exists, vlan_id, int_list)
+                report['plan'] = plan
+                if not dry_run:
+                    nxos = is_nxos(nb_device)
+                    change_set = build_change_set(vlan_id, plan['add'], 'add', vlan_name=vlan_name, nxos=nxos)
+                    if plan['remove']:
+                        change_set += build_change_set(vlan_id, plan['remove'], 'remove', nxos=nxos)
+                    print('{}: vlan {} add {}; remove {}'.format(device, vlan_id, ', '.join(plan['add']) or '-',
+                                                                 ', '.join(plan['remove']) or '-'))
+                    output, errors = ssh.send_config(change_set)
+                    # проверка по разрешенным vlan'ам транков из нового снимка running-config, как и план
+                    # (show vlan id на ios показывает только access порты, а на nx-os - только активные транки)
+                    missing, left = verify_device(ssh.send('show running-config', timeout=120), vlan_id,
+                                                  int_list, plan['remove'])
+                    report['remove'] = ('Error! vlan остался на портах: ' + ', '.join(left)) if left else 'Successfully'
+                    if errors or missing:
+                        report['add'] = ('Error! vlan {} не прописан на портах: {} {}'.format(
+                            vlan_id, ', '.join(missing), '; '.join(errors)))
+                    else:
+                        report['add'] = 'Successfully'
+        finally:
+            client.close()
+    except Exception as error:
+        report['error'] = '{}: {}'.format(type(error).__name__, error)
+    report['elapsed'] = time.time() - started
+    return report
+
+
+def vlan_groups(contexts, devices):
+    # vlan группы всех железок (группа называется так же, как железка) из общего кэша,
+    # заодно в нем оказываются ip и логопасс всех железок для воркеров
+    prefetched = contexts.prefetch(devices)
+    missing = [device for device in devices if prefetched[device].vlan_group is None]
+    if missing:
+        raise ValueError('VLAN group not found in NetBox for: {}'.format(', '.join(missing)))
+    return [prefetched[device].vlan_group for device in devices]
+
+
+def used_vlan_bitmap(nb, groups):
+    # занятые vid всех групп одним постраничным запросом, сложенные в битовую карту на 4096 vlan'ов (бит N = vid N занят)
+    bitmap = 0
+    for vlan in nb.ipam.vlans.filter(group_id=[group.id for group in groups]):
+        bitmap |= 1 << int(vlan.vid)
+    return bitmap
+
+
+def free_vlans(bitmap, first=VLAN_RANGE_FIRST, last=VLAN_RANGE_LAST, count=1):
+    # первые count свободных vid в диапазоне first..last
+    result = []
+    for vid in range(max(1, first), min(last, 4094) + 1):
+        if not bitmap >> vid & 1:
+            result.append(vid)
+            if len(result) == count:
+                break
+    return result
+
+
+def vid_conflict(error):
+    # ответ нетбокса на занятый vid: 400 и "VLAN with this Group and VID already exists."
+    status = getattr(getattr(error, 'req', None), 'status_code', None)
+    return status == 400 and re.search(r'\bvid\b', str(error.error), re.IGNORECASE) is not None
+
+
+def reserve_vlan(nb, groups, vlan_name, first=VLAN_RANGE_FIRST, last=VLAN_RANGE_LAST, attempts=5):
+    # выбираем первый свободный во всех группах vid и сразу создаем vlan во всех группах одним bulk запросом
+    # bulk создание в нетбоксе идет одной транзакцией: если параллельный запуск уже занял vid хотя бы в одной группе,
+    # не создается ничего - тогда перечитываем занятые vid и пробуем следующий
+    for attempt in range(attempts):
+        free = free_vlans(used_vlan_bitmap(nb, groups), first, last)
+        if not free:
+            raise ValueError('No free VLAN in range {}-{}'.format(first, last))
+        vlan_id = free[0]
+        try:
+            nb.ipam.vlans.create([dict(group=group.id, vid=vlan_id, name=vlan_name, status='active')
+                                  for group in groups])
+            return vlan_id
+        except pynetbox.RequestError as error:
+            # следующий vid пробуем только на ошибку уникальности vid в группе (400 от нетбокса);
+            # любая другая ошибка (в том числе сетевая - POST api_client не повторяет, и vlan мог успеть создаться)
+            # пробрасывается, иначе vlan'ы зарезервировались бы сразу под несколько vid
+            if not vid_conflict(error):
+                raise
+            print('Vlan {} уже занят параллельным запуском, пробую следующий: {}'.format(vlan_id, error.error))
+    raise RuntimeError('Could not reserve VLAN after {} attempts'.format(attempts))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Протаскивание нового vlan по списку железок devices_interfaces')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='только показать план по каждой железке, ничего не менять ни на железках, ни в нетбоксе')
+    return parser.parse_args()
+
+
+def create_vlan_fun(dry_run=False):
+    vlan_name = input("Введите имя vlan'a: ")
+    groups = vlan_groups(contexts, list(devices_interfaces))
+    if dry_run:
+        # в dry run vlan в нетбоксе не резервируем, а только смотрим первый свободный
+        free = free_vlans(used_vlan_bitmap(nb, groups))
+        if not free:
+            raise ValueError('No free VLAN in range {}-{}'.format(VLAN_RANGE_FIRST, VLAN_RANGE_LAST))
+        vlan_id = free[0]
+    else:
+        vlan_id = reserve_vlan(nb, groups, vlan_name)
     print('Свободный vlan = ', vlan_id)
 
-    future_list = []
-    future_list_2 = []
-    int_list = []
-    #print("starting point: ",time.time())
-
-    with ProcessPoolExecutor(max_workers=20) as executor:
-        for device,int_number in devices_interfaces.items():
-            print('Захожу на железку {} чтобы УДАЛИТЬ выбранный vlanID с ненужных портов: '.format(device))
-            future = executor.submit(delete_vlan,device,vlan_id)
-        for f in as_completed(future_list):
-            print(f.result())
-        print('Vlans deleted')
-
-    # Прописываем vlan
-    with ProcessPoolExecutor(max_workers=20) as executor:
-        for device_name,interface_dictionary in devices_interfaces.items():
-            int_list = []
-            for key1, interface in interface_dictionary.items():
-                int_list.append(interface)
-            device = device_name
-            print("Настраиваю vlan на:", device, ";   Interface list ", int_list)
-            future = executor.submit(create_vlan, device, vlan_id, vlan_name, int_list)
-            #create_vlan(device,vlan_id,vlan_name,int_list)
-
-        for fa in as_completed(future_list_2):
-            print(fa.result())
-        print('Vlans created')
+    # раскатка по всем железкам параллельно в потоках (работа упирается в сеть, процессы тут не нужны)
+    # общее время близко ко времени самой медленной железки
+    reports = []
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        futures = [executor.submit(rollout_device, device, vlan_id, vlan_name, list(interface_dictionary.values()),
+                                   dry_run)
+                   for device, interface_dictionary in devices_interfaces.items()]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            print(report['device'], report['error'] or report['add'])
+
+    print('Отчет по железкам:')
+    for report in sorted(reports, key=lambda item: item['device']):
+        plan = report['plan'] or {'add': [], 'remove': []}
+        print('{}: {:.1f} s; plan add: {}; plan remove: {}; remove: {}; add: {}; error: {}'.format(
+            report['device'], report['elapsed'], ', '.join(plan['add']) or '-', ', '.join(plan['remove']) or '-',
+            report['remove'], report['add'], report['error']))
+    if dry_run:
+        return vlan_id
+    failed = [report['device'] for report in reports if report['error'] or str(report['add']).startswith('Error')]
+    print('Vlans created' if not failed else 'Vlan не прописан на: {}'.format(', '.join(failed)))
+    print(api_client.report())
 
     return vlan_id
 
 if __name__ == "__main__":
-    create_vlan_fun()
\ No newline at end of file
+    create_vlan_fun(dry_run=get_args().dry_run)
\ No newline at end of file
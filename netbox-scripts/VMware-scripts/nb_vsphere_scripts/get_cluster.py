@@ -1,102 +1,94 @@
 #!/home/netbox-scripter/netbox_venv/bin/python
 
 from __future__ import print_function
-from pyVim.connect import SmartConnect, Disconnect
-import atexit
+from pyVim.connect import SmartConnect, SmartStubAdapter, Disconnect
+from pyVmomi import vim, vmodl
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import json
-import pynetbox
+import os
+import queue
 import sys
+import threading
+import time
+import traceback
 sys.path.insert(1, '/home/netbox-scripter/netbox-git')
 import config
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import api_client
+from device_context import DeviceContextResolver
+from vm_record import Disk, GuestNic, VMRecord
 
-data = {}
+#в файле состояния инкрементального режима лежит cookie живой сессии vCenter,
+#поэтому он хранится не в текущем каталоге, а в закрытом каталоге пользователя (0700, сам файл 0600)
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.nb_vsphere')
 
 #функция getNic используется для получения информации о виртуальных адаптерах каждой конкретной ВМ
 def getNICs(summary, guest):
-    nics = {}
+    nics = []
     for nic in guest.net:
         if nic.network:  # Only return adapter backed interfaces
             if nic.ipConfig is not None and nic.ipConfig.ipAddress is not None:
-                nics[nic.macAddress] = {}  # Use mac as uniq ID for nic
-                nics[nic.macAddress]['netlabel'] = nic.network
-                ipconf = nic.ipConfig.ipAddress
-                i = 0
-                nics[nic.macAddress]['ipv4'] = {}
-                for ip in ipconf:
-                    if ":" not in ip.ipAddress:  # Only grab ipv4 addresses
-                        nics[nic.macAddress]['ipv4'][i] = ip.ipAddress
-                        nics[nic.macAddress]['prefix'] = ip.prefixLength
-                        nics[nic.macAddress]['connected'] = nic.connected
-                i = i+1
+                # Only grab ipv4 addresses
+                ipv4 = [ip for ip in nic.ipConfig.ipAddress if ":" not in ip.ipAddress]
+                nics.append(GuestNic(mac=nic.macAddress,
+                                     network=nic.network,
+                                     ipv4=[ip.ipAddress for ip in ipv4],
+                                     prefix=ipv4[-1].prefixLength if ipv4 else None,
+                                     connected=bool(nic.connected)))
     return nics
 
 
 def vmsummary(summary, guest, storage, mem, hardware, snapshot):
+    #возвращает словарь с полями VMRecord (кроме dc/cluster/host/name/folder, их добавляет vm2dict)
     vmsum = {}
     config = summary.config
     net = getNICs(summary, guest)
-    #оперативная память
-    vmsum['mem'] = str(config.memorySizeMB / 1024)
+    #оперативная память в ГБ
+    vmsum['mem_gb'] = config.memorySizeMB / 1024
     #сумма всех жестких дисков ВМ
-    vmsum['diskGBTotal'] = round(int(float("%.2f" % (summary.storage.committed / 1024**3))))+round(int(float("%.2f" % (summary.storage.uncommitted / 1024**3))))
+    vmsum['disk_total_gb'] = summary.storage.committed // 1024**3 + summary.storage.uncommitted // 1024**3
     #кол-во цпу
-    vmsum['cpu'] = str(config.numCpu)
+    vmsum['cpu'] = config.numCpu
     #папка, в которой лежит вм
-    vmsum['path'] = config.vmPathName
+    vmsum['path'] = config.vmPathName or ''
     #операционная система, на которой работает вм
-    vmsum['ostype'] = config.guestFullName
+    vmsum['ostype'] = config.guestFullName or ''
     #состояние вм (вкл выкл)
     vmsum['state'] = summary.runtime.powerState
     #дескрипшн, который дописывают сами вертельщики.
     #здесь стоит отметить, что в аннотациях иногда содержатся пароли к ВМ. возможно этот кусок кода вообще следует удалить, т.к. мы его все равно пока что не используем
     vmsum['annotation'] = config.annotation if config.annotation else ''
     #в функцию net записывается результат выполнения функции getNic
-    vmsum['net'] = net
+    vmsum['guest_net'] = net
     #общее кол-во сетевых интерфейсов
-    vmsum['TotalNics'] = summary.config.numEthernetCards
+    vmsum['total_nics'] = summary.config.numEthernetCards or 0
     #осуществляется ли на данной ВМ резервация оперативной памяти (true or false)
-    vmsum['MemoryReservation'] = mem
-    j=0
-    i=0
-    k=0
+    vmsum['memory_reservation'] = bool(mem)
+    vmsum['thin_provisioned'] = False
+    vmsum['disks'] = []
+    vmsum['nics'] = []
     #следующий кусок кода необходим для определения количества и типов жестких дисков, прицепленных к каждой конкретной ВМ
     #метод vim.vm.VirtualHardware позволяет получить список всех виртуальных устройств, такие как жесткие диски, сетевые адаптеры, и т.д.
     for hard_disk in hardware:
         #далее в цикле мы вычленяем из всего мусора только жесткие диски
         if 'Hard disk' in hard_disk.deviceInfo.label:
             try:
-                if hard_disk.backing.thinProvisioned == True:
-                    vmsum['ThinProv'] = 'True'
-                else:
-                    vmsum['ThinProv'] = 'False'
+                vmsum['thin_provisioned'] = hard_disk.backing.thinProvisioned == True
             except AttributeError:
-                vmsum['ThinProv'] = 'False'
+                vmsum['thin_provisioned'] = False
             #следующим этапом является отделение RDM дисков от обычных (толстых или тонких)
-            if 'independent_persistent' in hard_disk.backing.diskMode:
-                #тут мы записываем хранилку, на которой томится данный rdm диск
-                vmsum['RDM_DISK_info_{}'.format(j)] = hard_disk.backing.fileName
-                #тут мы фиксируем объем данного диска
-                vmsum['RDM_DISK_Total_{}'.format(j)] = ("%.2f" % (hard_disk.capacityInKB // 1024**2))
-                j=j+1
-            else:
-                #оставшийся кусок кода делает тоже самое, но уже для всех остальных дисков (НЕ rdm)
-                vmsum['Storage_info_{}'.format(i)] = hard_disk.backing.fileName
-                vmsum['Storage_TotalDisk_{}'.format(i)]= ("%.2f" % (hard_disk.capacityInKB // 1024**2))
-                i=i+1
+            #и фиксация хранилки, на которой томится данный диск, и его объема в ГБ
+            vmsum['disks'].append(Disk(path=hard_disk.backing.fileName,
+                                       size_gb=hard_disk.capacityInKB // 1024**2,
+                                       rdm='independent_persistent' in hard_disk.backing.diskMode))
         #разобравшись с жесткими дисками, вычленяем сетевые адаптеры и записываем их мак адреса
         elif 'Network adapter' in hard_disk.deviceInfo.label:
-            vmsum['network_adapter_{}'.format(k)] = hard_disk.macAddress
-            k=k+1
-    #следующими тремя строками фиксируем количество rdm дисков, количество других жестких дисков, кол-во сетевых адаптеров
-    #это пригодится нам в дальнейшем (в следующих скриптах)
-    vmsum['RDM_index_num']=j
-    vmsum['Storage_index_num']=i
-    vmsum['network_index_num']=k
+            vmsum['nics'].append(hard_disk.macAddress)
     #методом snapshot определяем есть ли на тачке СНАПШОТ
-    if snapshot != None:
-        vmsum['Snapshot'] = 'True'
-    else:
-        vmsum['Snapshot'] = 'False'
+    vmsum['snapshot'] = snapshot is not None
+    #instance uuid не меняется при переименовании ВМ, по нему nb_vm.py находит переименованные ВМ
+    vmsum['instance_uuid'] = config.instanceUuid or ''
 
     return vmsum
     #Возникает вопрос, зачем выдергивать сетевые адаптеры отдельно, если это делает функция getNic
@@ -108,106 +100,625 @@ def vmsummary(summary, guest, storage, mem, hardware, snapshot):
     #баги функции getNic связаны с тулзами, которые установлены\не установлены на виртуалках. так же это зависит от версии тулзов.
     # с последними версиями все работает корректно, но последние версии стоят далеко не везде
 
-#функцией  vm2dict формируем словарь из всех переменных, которые были получены нами ранее
-def vm2dict(dc, cluster, host, vm, summary):
+#функцией vm2dict формируем запись VMRecord из всех переменных, которые были получены нами ранее
+def vm2dict(dc, cluster, host, vm, summary, data):
     # If nested folder path is required, split into a separate function
     vmname = vm.summary.config.name
-    data[dc][cluster][host][vmname]['folder'] = vm.parent.name
-    data[dc][cluster][host][vmname]['mem'] = summary['mem']
-    data[dc][cluster][host][vmname]['diskGBTotal'] = summary['diskGBTotal']
-    data[dc][cluster][host][vmname]['cpu'] = summary['cpu']
-    data[dc][cluster][host][vmname]['path'] = summary['path']
-    data[dc][cluster][host][vmname]['net'] = summary['net']
-    data[dc][cluster][host][vmname]['ostype'] = summary['ostype']
-    data[dc][cluster][host][vmname]['state'] = summary['state']
-    data[dc][cluster][host][vmname]['annotation'] = summary['annotation']
-    data[dc][cluster][host][vmname]['TotalNics'] = summary['TotalNics']
-    data[dc][cluster][host][vmname]['RDM_index_num'] = summary['RDM_index_num']
-    data[dc][cluster][host][vmname]['ThinProv'] = summary['ThinProv']
-    data[dc][cluster][host][vmname]['Storage_index_num'] = summary['Storage_index_num']
-    data[dc][cluster][host][vmname]['MemoryReservation'] = summary['MemoryReservation']
-    data[dc][cluster][host][vmname]['network_index_num'] = summary['network_index_num']
-    for i in range(summary['Storage_index_num']):
-        data[dc][cluster][host][vmname]['Storage_info_{}'.format(i)] = summary['Storage_info_{}'.format(i)]
-        data[dc][cluster][host][vmname]['Storage_TotalDisk_{}'.format(i)] = summary['Storage_TotalDisk_{}'.format(i)]
-    if summary['RDM_index_num'] > 0:
-        for k in range(summary['RDM_index_num']):
-            data[dc][cluster][host][vmname]['RDM_DISK_info_{}'.format(k)] = summary['RDM_DISK_info_{}'.format(k)]
-            data[dc][cluster][host][vmname]['RDM_DISK_Total_{}'.format(k)] = summary['RDM_DISK_Total_{}'.format(k)]
-    data[dc][cluster][host][vmname]['Snapshot'] = summary['Snapshot']
-    for m in range(summary['network_index_num']):
-        data[dc][cluster][host][vmname]['network_adapter_{}'.format(m)]=summary['network_adapter_{}'.format(m)]
+    data[dc][cluster][host][vmname] = VMRecord(dc=dc, cluster=cluster, host=host, name=vmname,
+                                               folder=vm.parent.name or '', **summary)
+
+
+#свойства ВМ, которые реально читают функции vmsummary, getNICs и vm2dict
+#в bulk режиме запрашиваем у PropertyCollector только их, а не весь объект целиком
+#vm.storage.perDatastoreUsage в vmsummary не используется, поэтому его не тянем
+VM_PROPERTIES = [
+    'parent',
+    'runtime.host',
+    'summary.config.name',
+    'summary.config.memorySizeMB',
+    'summary.config.numCpu',
+    'summary.config.vmPathName',
+    'summary.config.guestFullName',
+    'summary.config.annotation',
+    'summary.config.numEthernetCards',
+    'summary.config.instanceUuid',
+    'summary.storage.committed',
+    'summary.storage.uncommitted',
+    'summary.runtime.powerState',
+    'guest.net',
+    'config.memoryReservationLockedToMax',
+    'config.hardware.device',
+    'snapshot',
+]
+
+#свойства остальных объектов инвентаря, из которых локально собирается дерево dc/cluster/host
+INVENTORY_PROPERTIES = {
+    vim.Datacenter: ['name', 'parent'],
+    vim.Folder: ['name', 'parent'],
+    vim.ComputeResource: ['name', 'parent'],
+    vim.HostSystem: ['summary.config.name', 'parent'],
+}
+
+#значения по умолчанию для свойств, которые vCenter не возвращает, если они не заданы
+#(например у выключенной ВМ нет guest.net)
+VM_PROPERTY_DEFAULTS = {
+    'guest.net': [],
+    'config.hardware.device': [],
+}
+
+
+class PropertyTree(object):
+    #объект-заглушка, который по плоскому словарю вида {'summary.config.numCpu': 2}
+    #позволяет обращаться к значениям так же, как к объекту pyVmomi: obj.summary.config.numCpu
+    #благодаря этому vmsummary и vm2dict работают в bulk режиме без изменений
+    def __init__(self, props, prefix=''):
+        self._props = props
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        path = self._prefix + name
+        if path in self._props:
+            return self._props[path]
+        nested = path + '.'
+        if any(key.startswith(nested) for key in self._props):
+            return PropertyTree(self._props, nested)
+        return None
+
+
+def paged_retrieve(pc, filter_spec, page_size):
+    #RetrievePropertiesEx отдает первую страницу, ContinueRetrievePropertiesEx - все следующие по токену
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = pc.RetrievePropertiesEx([filter_spec], options)
+    while result:
+        for obj_content in result.objects:
+            props = {prop.name: prop.val for prop in obj_content.propSet}
+            yield obj_content.obj, props
+        if not result.token:
+            break
+        result = pc.ContinueRetrievePropertiesEx(result.token)
+
+
+def view_filter_spec(view, obj_types):
+    #спецификация фильтра "все объекты нужных типов внутри ContainerView"
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(
+        name='traverseEntities', path='view', skip=False, type=vim.view.ContainerView)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=paths)
+                  for obj_type, paths in obj_types.items()]
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+
+
+def retrieve_properties(si, container, obj_types, page_size):
+    #один проход PropertyCollector по ContainerView. количество запросов к vCenter
+    #растет с количеством страниц, а не с количеством ВМ * количество свойств
+    content = si.RetrieveContent()
+    view = content.viewManager.CreateContainerView(container, list(obj_types), True)
+    try:
+        for obj, props in paged_retrieve(content.propertyCollector, view_filter_spec(view, obj_types), page_size):
+            yield obj, props
+    finally:
+        view.Destroy()
+
+
+def retrieve_vms(si, vms, page_size):
+    #забираем свойства конкретного списка ВМ (без обхода инвентаря), используется в инкрементальном режиме
+    content = si.RetrieveContent()
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=vm, skip=False) for vm in vms]
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+    return paged_retrieve(content.propertyCollector, filter_spec, page_size)
+
+
+def retrieve_inventory(si, page_size, data):
+    #забираем "скелет" инвентаря: датацентры, папки, кластеры и хосты,
+    #и заводим в data пустые кластеры и хосты (как это делает обычный обход)
+    #возвращаем сам инвентарь, словарь хост -> (dc, cluster, hostname) и список кластеров (объект, dc, cluster)
+    content = si.RetrieveContent()
+    inventory = {}
+    for obj, props in retrieve_properties(si, content.rootFolder, INVENTORY_PROPERTIES, page_size):
+        inventory[obj] = props
+
+    def find_datacenter(obj):
+        #поднимаемся по parent до датацентра (кластер может лежать во вложенной папке)
+        while obj is not None and not isinstance(obj, vim.Datacenter):
+            obj = inventory.get(obj, {}).get('parent')
+        return obj
+
+    hosts = {}
+    clusters = []
+    for obj, props in inventory.items():
+        if isinstance(obj, vim.ComputeResource):
+            dc = find_datacenter(props.get('parent'))
+            if dc is None:
+                continue
+            dc_name = inventory[dc]['name']
+            data.setdefault(dc_name, {})[props['name']] = {}
+            clusters.append((obj, dc_name, props['name']))
+    for obj, props in inventory.items():
+        if isinstance(obj, vim.HostSystem):
+            cluster = props.get('parent')
+            dc = find_datacenter(cluster)
+            if dc is None or cluster not in inventory:
+                continue
+            dc_name = inventory[dc]['name']
+            cluster_name = inventory[cluster]['name']
+            hostname = props['summary.config.name']
+            data[dc_name][cluster_name][hostname] = {}
+            hosts[obj] = (dc_name, cluster_name, hostname)
+    return inventory, hosts, clusters
+
+
+def add_vm(data, inventory, hosts, props):
+    #раскладываем свойства одной ВМ, полученные от PropertyCollector, в дерево data[dc][cluster][host][vm]
+    #возвращаем (dc, cluster, vmname) или None, если ВМ не относится ни к одному хосту из инвентаря
+    location = hosts.get(props.get('runtime.host'))
+    if location is None:
+        #ВМ на хосте вне кластера, в обычном режиме она тоже не попадает в выгрузку
+        return None
+    dc_name, cluster_name, hostname = location
+    for path, default in VM_PROPERTY_DEFAULTS.items():
+        props.setdefault(path, default)
+    #vm2dict берет имя папки из vm.parent.name
+    folder = props.pop('parent', None)
+    props['parent.name'] = inventory.get(folder, {}).get('name', '')
+    vm = PropertyTree(props)
+    vmname = vm.summary.config.name
+    summary = vmsummary(vm.summary, vm.guest, None,
+                        vm.config.memoryReservationLockedToMax, vm.config.hardware.device,
+                        vm.snapshot)
+    vm2dict(dc_name, cluster_name, hostname, vm, summary, data)
+    return dc_name, cluster_name, vmname
+
+
+def collect_bulk(si, page_size):
+    #bulk режим: вместо обхода rootFolder -> datacenter -> cluster -> host -> vm с отдельным
+    #SOAP запросом на каждое свойство каждой ВМ, забираем все нужные свойства постранично
+    #и собираем то же самое дерево [dc][cluster][host][vm] локально
+    #ВМ забираются отдельным проходом по каждому кластеру, чтобы кластер можно было отдать
+    #в выгрузку целиком сразу после его обхода, не держа в памяти весь вцентр
+    #генератор, отдает (dc, cluster, {host: {vm: {...}}})
+    skeleton = {}
+    inventory, hosts, clusters = retrieve_inventory(si, page_size, skeleton)
+    for cluster_obj, dc_name, cluster_name in clusters:
+        chunk = {dc_name: {cluster_name: skeleton[dc_name][cluster_name]}}
+        for obj, props in retrieve_properties(si, cluster_obj, {vim.VirtualMachine: VM_PROPERTIES}, page_size):
+            location = hosts.get(props.get('runtime.host'))
+            if location is None or location[:2] != (dc_name, cluster_name):
+                continue
+            add_vm(chunk, inventory, hosts, props)
+        yield dc_name, cluster_name, chunk[dc_name][cluster_name]
+
+
+def create_update_filter(si):
+    #создаем отдельный PropertyCollector с фильтром на свойства всех ВМ
+    #отдельный коллектор нужен, чтобы наш фильтр не смешивался с чужими фильтрами в той же сессии
+    #ContainerView не уничтожаем - фильтр на нее ссылается, живут они вместе с сессией
+    content = si.RetrieveContent()
+    pc = content.propertyCollector.CreatePropertyCollector()
+    view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+    pc.CreateFilter(view_filter_spec(view, {vim.VirtualMachine: VM_PROPERTIES}), partialUpdates=False)
+    return pc
+
+
+def wait_for_updates(pc, version, page_size):
+    #забираем все накопившиеся изменения с версии version, не дожидаясь новых (maxWaitSeconds=0)
+    #возвращаем новую версию, словарь moId -> (ВМ, kind, свойства) и множество moId удаленных ВМ
+    #для kind=enter свойства полные, для modify - только изменившиеся
+    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0, maxObjectUpdates=page_size)
+    changed = {}
+    left = set()
+    while True:
+        update = pc.WaitForUpdatesEx(version, options)
+        if update is None:
+            break
+        version = update.version
+        for filter_set in update.filterSet:
+            for obj_update in filter_set.objectSet:
+                moid = obj_update.obj._moId
+                if obj_update.kind == 'leave':
+                    changed.pop(moid, None)
+                    left.add(moid)
+                else:
+                    left.discard(moid)
+                    props = {change.name: change.val for change in obj_update.changeSet if change.op != 'remove'}
+                    previous = changed.get(moid)
+                    if previous and previous[1] == 'enter':
+                        #ВМ появилась и изменилась в рамках одной выдачи - она все равно считается новой
+                        previous[2].update(props)
+                    else:
+                        changed[moid] = (obj_update.obj, obj_update.kind, props)
+        if not update.truncated:
+            break
+    return version, changed, left
+
+
+def collect_incremental(si, page_size, state, fresh_session):
+    #инкрементальный режим: вместо полного обхода забираем через WaitForUpdatesEx только ВМ,
+    #которые были созданы, изменены или удалены с прошлого прогона
+    #state - состояние этого вцентра между прогонами: коллектор, версия и moId -> [dc, cluster, vm]
+    #если сессия или коллектор протухли, создаем новый фильтр: первая выдача с пустой версией
+    #содержит все ВМ, и такие кластеры помечаются как full (для них работает обычное удаление в нетбоксе)
+    changed_tree = {}
+    removed = {}
+    inventory, hosts, clusters = retrieve_inventory(si, page_size, changed_tree)
+
+    pc = None
+    version = None
+    if not fresh_session and state.get('collector') and state.get('version') is not None:
+        pc = vmodl.query.PropertyCollector(state['collector'], si._stub)
+        try:
+            version, changed, left = wait_for_updates(pc, state['version'], page_size)
+        except (vmodl.fault.ManagedObjectNotFound, vmodl.fault.InvalidArgument,
+                vmodl.query.InvalidCollectorVersion):
+            pc = None
+    full = pc is None
+    if full:
+        pc = create_update_filter(si)
+        version, changed, left = wait_for_updates(pc, '', page_size)
+        state['vms'] = {}
+    vms_state = state.setdefault('vms', {})
+
+    #в полной выдаче (kind=enter) changeSet уже содержит все свойства ВМ,
+    #а для modify в нем только изменившиеся свойства - такие ВМ дочитываем одним запросом
+    to_fetch = []
+    vm_props = []
+    for moid, (obj, kind, props) in changed.items():
+        if kind == 'enter':
+            vm_props.append((moid, props))
+        else:
+            to_fetch.append(obj)
+    if to_fetch:
+        for obj, props in retrieve_vms(si, to_fetch, page_size):
+            vm_props.append((obj._moId, props))
+
+    for moid, props in vm_props:
+        location = add_vm(changed_tree, inventory, hosts, props)
+        previous = vms_state.get(moid)
+        if previous and (location is None or list(location) != previous):
+            #ВМ переехала в другой кластер или была переименована - старую запись надо удалить
+            removed.setdefault(previous[1], []).append(previous[2])
+        if location is None:
+            vms_state.pop(moid, None)
+        else:
+            vms_state[moid] = list(location)
+    for moid in left:
+        previous = vms_state.pop(moid, None)
+        if previous:
+            removed.setdefault(previous[1], []).append(previous[2])
+
+    full_clusters = []
+    if full:
+        full_clusters = [cluster for clusters in changed_tree.values() for cluster in clusters]
+    else:
+        #в дельту попадают только кластеры, в которых что-то изменилось
+        for dc in list(changed_tree):
+            for cluster in list(changed_tree[dc]):
+                if not any(changed_tree[dc][cluster].values()):
+                    del changed_tree[dc][cluster]
+            if not changed_tree[dc]:
+                del changed_tree[dc]
+
+    state['collector'] = pc._moId
+    state['version'] = version
+    state['cookie'] = si._stub.cookie
+    return {'changed': changed_tree, 'removed': removed, 'full_clusters': full_clusters}
+
+
+def collect_tree(si):
+    #классический режим: последовательный обход всего дерева объектов vCenter
+    #генератор, отдает (dc, cluster, {host: {vm: {...}}}) по мере обхода каждого кластера
+    content = si.RetrieveContent()
+    children = content.rootFolder.childEntity
+    for child in children:  # Iterate though DataCenters
+        dc = child
+        clusters = dc.hostFolder.childEntity
+        for cluster in clusters:  # Iterate through the clusters in the DC
+            # Add Clusters to data dict
+            data = {dc.name: {cluster.name: {}}}
+            hosts = cluster.host  # Variable to make pep8 compliance
+            for host in hosts:  # Iterate through Hosts in the Cluster
+                hostname = host.summary.config.name
+                # Add VMs to data dict by config name
+                data[dc.name][cluster.name][hostname] = {}
+                vms = host.vm
+                for vm in vms:  # Iterate through each VM on the host
+                    vmname = vm.summary.config.name
+                    # функции summary передаем аргументы, относящиеся к конкретной ВМ
+                    # и которые используются в дальнейшем
+                    #api vmware которое использовалось в этом скрипте:
+                    #https://vdc-download.vmware.com/vmwb-repository/dcr-public/6b586ed2-655c-49d9-9029-bc416323cb22/fa0b429a-a695-4c11-b7d2-2cbc284049dc/doc/vim.VirtualMachine.html#field_detail
+                    summary = vmsummary(vm.summary, vm.guest, vm.storage.perDatastoreUsage,
+                                        vm.config.memoryReservationLockedToMax, vm.config.hardware.device,
+                                        vm.snapshot)
+                    #получив всю необходимую информацию, формируем словарь, который в дальнейшем отдается в выгрузку
+                    vm2dict(dc.name, cluster.name, hostname, vm, summary, data)
+            yield dc.name, cluster.name, data[dc.name][cluster.name]
+
+
+def add_collector_args(parser):
+    #параметры сборщика, общие для get_cluster.py и nb_pipeline.py
+    parser.add_argument('--bulk', action='store_true',
+                        help='собирать инвентарь через PropertyCollector (RetrievePropertiesEx) постранично')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='количество объектов в одной странице RetrievePropertiesEx')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='сколько вцентров опрашивать одновременно')
+    parser.add_argument('--incremental', action='store_true',
+                        help='забрать через WaitForUpdatesEx только изменения с прошлого прогона')
+    parser.add_argument('--state-file', default=os.path.join(STATE_DIR, 'vsphere_state.json'),
+                        help='файл, в котором между прогонами хранятся сессии и версии WaitForUpdatesEx '
+                             '(создается с правами 0600)')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Выгрузка инвентаря ВМ из vCenter в output.ndjson')
+    add_collector_args(parser)
+    parser.add_argument('-o', '--output', default='output.ndjson',
+                        help='куда писать выгрузку (по одной json-записи на строку), "-" - stdout')
+    parser.add_argument('--commit-state', action='store_true',
+                        help='подтвердить, что выгрузка последнего --incremental прогона залита в нетбокс: '
+                             'его состояние (<state-file>.pending) становится текущим')
+    return parser.parse_args()
+
 
 def data2json(data, args):
     with open(args.jsonfile, 'w') as f:
         json.dump(data, f)
 
 
-def main():
+def connect_vcenter(contexts, device_name, cookie=None):
+    #в инкрементальном режиме сначала пробуем переиспользовать сессию прошлого прогона по cookie:
+    #версия WaitForUpdatesEx и фильтр живут только внутри сессии vCenter
+    #возвращаем si и признак того, что сессия новая
+    if cookie:
+        stub = SmartStubAdapter(host='', port=int('443'), disableSslCertValidation=True)
+        stub.cookie = cookie
+        si = vim.ServiceInstance('ServiceInstance', stub)
+        try:
+            if si.content.sessionManager.currentSession is not None:
+                return si, False
+        except Exception:
+            pass
+
+    #далее, используя библиотеку pynetbox и встроенное api нетбокса
+    #получаем username и password для входа в VC
+    #логопасс был заранее внесен в нетбокс https://netbox.itpark.local/dcim/devices/102/
+    #секреты всех вцентров загружены одним запросом в iter_inventory, здесь только обращение к кэшу
+    ctx = contexts.get(device_name)
+    #после получения необходимых исходных данных, коннектимся к вцентру
+    si = SmartConnect(host='',
+                           user=ctx.username,
+                           disableSslCertValidation=True,
+                           pwd=ctx.password,
+                           port=int('443'))
+    if not si:
+        raise RuntimeError("Could not connect to the specified host using specified "
+                           "username and password")
+    return si, True
+
+
+def collect_vcenter(contexts, device_name, args, state, emit):
+    #воркер для одного вцентра: по мере обхода отдает через emit каждый собранный кластер целиком
+    #emit(('cluster', dc, cluster, {host: {vm: {...}}}, full)) и emit(('removed', cluster, vm))
+    #возвращает количество выгруженных ВМ
+    vm_count = 0
+    if args.incremental:
+        si, fresh_session = connect_vcenter(contexts, device_name, state.get('cookie'))
+        #сессию не закрываем: на следующем прогоне она переиспользуется вместе с фильтром
+        #состояние меняем на копии и сохраняем только при успехе, иначе следующий прогон
+        #заберет изменения со старой версии
+        new_state = json.loads(json.dumps(state))
+        delta = collect_incremental(si, args.page_size, new_state, fresh_session)
+        state.clear()
+        state.update(new_state)
+        full_clusters = set(delta['full_clusters'])
+        for dc, clusters in delta['changed'].items():
+            for cluster, hosts in clusters.items():
+                emit(('cluster', dc, cluster, hosts, cluster in full_clusters))
+                vm_count += sum(len(vms) for vms in hosts.values())
+        for cluster, removed in delta['removed'].items():
+            for vm in removed:
+                emit(('removed', cluster, vm))
+        return vm_count
+
+    si, fresh_session = connect_vcenter(contexts, device_name)
+    try:
+        clusters = collect_bulk(si, args.page_size) if args.bulk else collect_tree(si)
+        for dc, cluster, hosts in clusters:
+            emit(('cluster', dc, cluster, hosts, True))
+            vm_count += sum(len(vms) for vms in hosts.values())
+    finally:
+        Disconnect(si)
+    return vm_count
+
+
+class CollectionStopped(Exception):
+    #потребитель выгрузки остановился раньше времени, воркеру нужно бросить обход
+    pass
+
+
+def run_vcenter(contexts, device_name, args, state, emit):
+    #обертка над collect_vcenter, которая замеряет время и перехватывает ошибку,
+    #чтобы упавший вцентр не ронял остальные. по завершении всегда отдает ('done', ...)
+    started = time.time()
+    vm_count = 0
+    try:
+        vm_count = collect_vcenter(contexts, device_name, args, state, emit)
+        error = None
+    except CollectionStopped:
+        return
+    except Exception:
+        error = traceback.format_exc()
+    emit(('done', device_name, vm_count, time.time() - started, error))
+
+
+def write_record(out, record):
+    out.write(json.dumps(record, separators=(',', ':')))
+    out.write('\n')
+
+
+def cluster_records(dc, cluster, hosts, full):
+    #формат выгрузки: сначала запись о кластере, затем по одной записи на каждую его ВМ
+    #в записи кластера лежит количество ВМ, чтобы nb_vm.py мог убедиться, что кластер дочитан целиком
+    #full=False означает, что в кластере лежат только измененные ВМ (инкрементальный режим)
+    records = [{'kind': 'cluster', 'dc': dc, 'cluster': cluster, 'hosts': sorted(hosts), 'full': full,
+                'vms': sum(len(vms) for vms in hosts.values())}]
+    for vms in hosts.values():
+        for vm in vms.values():
+            record = vm.to_dict()
+            record['kind'] = 'vm'
+            records.append(record)
+    return records
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def get_vcenters():
     #в первую очередь определяется вцентр, к которому мы будем коннектиться
     dc_all = []
+    return dc_all
+
+
+def connect_netbox():
+    #далее указываются параметры подключения к нетбоксу,
+    #такие как api токен, ip нетбокса и т.д.
+    #данные параметры хранятся в скрипте config.py
+    #клиент один на все вцентры, воркеры используют его совместно (пул соединений и повторы - в api_client)
+    return api_client.netbox(config.netbox_url, config.netbox_token,
+                             private_key_file=config.private_key_file_path)
+
+
+def iter_inventory(nb, dc_all, args, state):
+    #генератор выгрузки: отдает записи пачками - кластер целиком (заголовок + его ВМ), запись об удаленной ВМ,
+    #и в самом конце запись end. его потребляет либо main (запись в файл), либо nb_pipeline.py (сразу заливка)
+    #каждый вцентр обходится в своем потоке, одновременно работает не больше args.workers воркеров
+    #общее время работы получается близким ко времени самого медленного вцентра, а не к сумме всех
+    #в инкрементальном режиме у каждого вцентра свое состояние, воркер меняет только его
+    #воркеры складывают собранные кластеры в ограниченную очередь, а потребитель забирает их по одному
+    #так в памяти одновременно находится не больше нескольких кластеров, а не весь инвентарь,
+    #а если потребитель не успевает, воркеры ждут на очереди (backpressure)
+    results = queue.Queue(maxsize=args.workers * 2)
+    #потребитель может остановиться раньше конца выгрузки (BrokenPipe на "-o -", ошибка заливки, Ctrl-C);
+    #тогда воркеры не должны навсегда повиснуть на put в полную очередь - они проверяют stop и бросают обход
+    stop = threading.Event()
+
+    def emit(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise CollectionStopped()
+
+    failed = []
+    #данные и логопасс всех вцентров одним запросом, воркеры берут их из общего кэша
+    contexts = DeviceContextResolver(nb, vlan_groups=False)
+    try:
+        contexts.prefetch(dc_all)
+    except Exception:
+        #не страшно: каждый воркер дозапросит свой вцентр сам
+        print('Error! Error while prefetch vCenter credentials', file=sys.stderr)
+        print('Error:\n', traceback.format_exc(), file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_vcenter, contexts, device_name, args, state.setdefault(device_name, {}), emit)
+                   for device_name in dc_all]
+        finished = 0
+        try:
+            while finished < len(dc_all):
+                item = results.get()
+                if item[0] == 'cluster':
+                    yield cluster_records(*item[1:])
+                elif item[0] == 'removed':
+                    yield [{'kind': 'removed', 'cluster': item[1], 'name': item[2]}]
+                elif item[0] == 'done':
+                    finished += 1
+                    device_name, vm_count, elapsed, error = item[1:]
+                    if error:
+                        failed.append(device_name)
+                        print(f'Error! Error while collect vCenter {device_name} ({elapsed:.1f} s)', file=sys.stderr)
+                        print('Error:\n', error, file=sys.stderr)
+                    else:
+                        print(f'{device_name}: {vm_count} VMs in {elapsed:.1f} s', file=sys.stderr)
+        finally:
+            if finished < len(dc_all):
+                #генератор закрыт или упал раньше конца выгрузки (GeneratorExit, исключение потребителя):
+                #останавливаем воркеров и освобождаем очередь до того, как выход из with начнет их ждать
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                while True:
+                    try:
+                        results.get_nowait()
+                    except queue.Empty:
+                        break
+
+    if failed:
+        print(f'Failed vCenters: {", ".join(failed)}', file=sys.stderr)
+    #последняя запись говорит потребителю, что выгрузка закончена, а не оборвалась на середине
+    yield [{'kind': 'end', 'failed': failed}]
+
+
+def save_state(path, state):
+    #файл сразу создается с правами 0600 (cookie сессии vCenter не должна быть видна другим пользователям)
+    #и подменяет старый целиком, чтобы упавшая запись не оставила половину состояния
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def pending_state_path(path):
+    return path + '.pending'
+
+
+def commit_state(path):
+    #состояние прогона --incremental становится текущим только после подтверждения, что его выгрузка залита:
+    # get_cluster.py --incremental -o out.ndjson && nb_vm.py --input out.ndjson && get_cluster.py --commit-state
+    #если заливка упала или не запускалась, следующий прогон заберет те же изменения еще раз
+    #(в nb_pipeline.py подтверждать не нужно - он сохраняет состояние сам после успешной заливки)
+    pending = pending_state_path(path)
+    if not os.path.exists(pending):
+        print(f'Error! No pending incremental state {pending}', file=sys.stderr)
+        sys.exit(1)
+    os.replace(pending, path)
+
+
+def main():
+    args = get_args()
+    if args.commit_state:
+        commit_state(args.state_file)
+        return
+    nb = connect_netbox()
+    state = load_state(args.state_file) if args.incremental else {}
+    #nb_vm.py может начинать заливку (например через пайп с "-o -"), не дожидаясь конца обхода
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    for records in iter_inventory(nb, get_vcenters(), args, state):
+        for record in records:
+            write_record(out, record)
+        out.flush()
+    if out is not sys.stdout:
+        out.close()
 
-    for device_name in dc_all:
-        #далее указываются параметры подключения к нетбоксу,
-        #такие как api токен, ip нетбокса и т.д.
-        #данные параметры хранятся в скрипте config.py
-        nb = pynetbox.api(
-            config.netbox_url,
-            private_key_file=config.private_key_file_path,
-            token=config.netbox_token
-
-        )
-
-        #далее, используя библиотеку pynetbox и встроенное api нетбокса
-        #получаем класс, содержащий в себе 2 метода для получения username и password для входа в VC
-        #логопасс был заранее внесен в нетбокс https://netbox.itpark.local/dcim/devices/102/
-        nb_secret = nb.plugins.netbox_secretstore.secrets.get(device=device_name)
-        #после получения необходимых исходных данных, коннектимся к вцентру
-        si = SmartConnect(host='',
-                               user=nb_secret.name,
-                               disableSslCertValidation=True,
-                               pwd=nb_secret.plaintext,
-                               port=int('443'))
-        if not si:
-            print("Could not connect to the specified host using specified "
-                  "username and password")
-            return -1
-        #следующие несколько строк являются для меня потемками, т.к. этот кусок кода был найден мной на просторах сети интернет
-        #однако, автор оказался предусмотрительным и вставил свои комментарии
-        atexit.register(Disconnect, si)
-
-        content = si.RetrieveContent()
-        children = content.rootFolder.childEntity
-        for child in children:  # Iterate though DataCenters
-            dc = child
-            data[dc.name] = {}  # Add data Centers to data dict
-            clusters = dc.hostFolder.childEntity
-            for cluster in clusters:  # Iterate through the clusters in the DC
-                # Add Clusters to data dict
-                data[dc.name][cluster.name] = {}
-                hosts = cluster.host  # Variable to make pep8 compliance
-                for host in hosts:  # Iterate through Hosts in the Cluster
-                    hostname = host.summary.config.name
-                    # Add VMs to data dict by config name
-                    data[dc.name][cluster.name][hostname] = {}
-                    vms = host.vm
-                    for vm in vms:  # Iterate through each VM on the host
-                        vmname = vm.summary.config.name
-                        data[dc.name][cluster.name][hostname][vmname] = {}
-                        # функции summary передаем аргументы, относящиеся к конкретной ВМ
-                        # и которые используются в дальнейшем
-                        #api vmware которое использовалось в этом скрипте:
-                        #https://vdc-download.vmware.com/vmwb-repository/dcr-public/6b586ed2-655c-49d9-9029-bc416323cb22/fa0b429a-a695-4c11-b7d2-2cbc284049dc/doc/vim.VirtualMachine.html#field_detail
-                        summary = vmsummary(vm.summary, vm.guest, vm.storage.perDatastoreUsage,
-                                            vm.config.memoryReservationLockedToMax, vm.config.hardware.device,
-                                            vm.snapshot)
-                        #получив всю необходимую информацию, формируем словарь, который в дальнейшем преобразовывается в json файлик
-                        vm2dict(dc.name, cluster.name, hostname, vm, summary)
-
-    sys.stdout = open("output.json", "w")
-    print(json.dumps(data, sort_keys=True, indent=4))
-    sys.stdout.close()
+    if args.incremental:
+        #новую версию WaitForUpdatesEx не делаем текущей, пока nb_vm.py не залил выгрузку (см. commit_state)
+        save_state(pending_state_path(args.state_file), state)
+        print(f'Incremental state saved to {pending_state_path(args.state_file)}, '
+              f'run "get_cluster.py --commit-state" after nb_vm.py succeeds', file=sys.stderr)
+    print(api_client.report(), file=sys.stderr)
 
 # Start program
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
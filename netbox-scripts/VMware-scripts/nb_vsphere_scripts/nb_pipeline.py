@@ -0,0 +1,71 @@
+#!/home/netbox-scripter/netbox_venv/bin/python
+
+import argparse
+import time
+import get_cluster
+import nb_vm
+
+#сбор ВМ с вцентров и заливка их в нетбокс одним процессом
+#раньше get_cluster.py сначала целиком дописывал выгрузку в файл, и только потом nb_vm.py начинал заливку,
+#т.е. время прогона = время сбора + время заливки
+#здесь сборщик отдает кластеры через ограниченную очередь прямо в заливку, и оба этапа работают одновременно:
+#пока заливается один кластер, воркеры уже обходят следующие. если заливка не успевает,
+#воркеры сборщика ждут на очереди, поэтому в памяти не копится весь инвентарь
+#файл выгрузки больше не нужен, но его можно сохранить (--snapshot) и потом перезалить: nb_vm.py --input <файл>
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Сбор ВМ из vCenter и заливка в нетбокс одним конвейером')
+    get_cluster.add_collector_args(parser)
+    nb_vm.add_sync_args(parser, workers_option='--sync-workers')
+    parser.add_argument('--snapshot', default=None,
+                        help='дополнительно записать выгрузку в этот файл (формат output.ndjson)')
+    return parser.parse_args()
+
+
+def iter_pipeline(nb, args, state, snapshot=None):
+    #плоский поток записей для nb_vm.sync_stream, по дороге (если нужно) пишет их в файл снапшота
+    inventory = get_cluster.iter_inventory(nb, get_cluster.get_vcenters(), args, state)
+    try:
+        for records in inventory:
+            for record in records:
+                if snapshot is not None:
+                    get_cluster.write_record(snapshot, record)
+                yield record
+            if snapshot is not None:
+                snapshot.flush()
+    finally:
+        #close() этого генератора сразу закрывает и сборщик (останавливает его воркеров)
+        inventory.close()
+
+
+def main():
+    start_time = time.time()
+    args = get_args()
+
+    nb = get_cluster.connect_netbox()
+    state = get_cluster.load_state(args.state_file) if args.incremental else {}
+    snapshot = open(args.snapshot, 'w') if args.snapshot else None
+    records = iter_pipeline(nb, args, state, snapshot)
+    try:
+        totals = nb_vm.run_sync(args, records)
+    finally:
+        #генератор закрываем явно: при Ctrl-C или ошибке в заливке его держат кадры traceback,
+        #и без close() воркеры сборщика не узнают об остановке и навсегда повиснут на полной очереди
+        records.close()
+        if snapshot is not None:
+            snapshot.close()
+
+    #состояние инкрементального режима сохраняем только после успешной заливки,
+    #иначе упавший прогон (или кластер) потерял бы изменения, забранные с вцентров
+    if args.incremental:
+        if totals['failed_clusters'] or totals['interrupted']:
+            print('Error! Sync failed, incremental state is not saved: next run will fetch the changes again')
+        else:
+            get_cluster.save_state(args.state_file, state)
+
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,348 +1,817 @@
 #!/home/netbox-scripter/netbox_venv/bin/python
 
+import argparse
 import json
+import os
 import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 sys.path.insert(1, '/home/netbox-scripter/netbox-git')
 import config
-import pynetbox
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import api_client
 import re
+import threading
 import time
 import traceback
+from vm_record import VMRecord
+from vm_state import FingerprintStore, fingerprint
+
+#имя custom field в нетбоксе, в котором хранится instance uuid ВМ из вмвары
+#если поле задано, по нему находятся переименованные ВМ; если нет - сопоставление идет только по имени
+UUID_FIELD = getattr(config, 'netbox_vm_uuid_field', None)
 
-start_time = time.time()
 #данный скрипт является вторым в общей логике заноса всех виртуалок на нетбокс
-#его суть заключается в том, что он открывает файлик output.json,
+#его суть заключается в том, что он построчно читает выгрузку output.ndjson,
 #и далее происходит обработка всей информации о виртуальных машинах,
 # которые содержатся в этом файлике с дальнейшим заносом этой инфы в нетбокс
-
-
-with open('output.json') as f:
-    templates = json.load(f)
-
-nb = pynetbox.api(
-    config.netbox_url,
-    private_key_file=config.private_key_file_path,
-    token=config.netbox_token
-)
-
-cluster_all = nb.virtualization.clusters.all()
-cluster_all_tuple = tuple(cluster_all)
-cluster_type_dc = nb.virtualization.cluster_types.get(name='')
-
-
-for dc in templates:
-    for cluster in templates[dc]:
-        #определяем 2 пустых множества
-        #это необходимо чтобы в дальнейшем удалять ВМ с нетбокса, которые были удалены на виртуализации
-        #эта логика будет определяться в самом конце скрипта, о ней я напишу отдельно
-        set_ipam_vm = set()
-        set_vmware_vm = set()
-
-
-        iscluster_exist = False
-        for nb_cluster in cluster_all_tuple:
-            if str(cluster) == str(nb_cluster.name):
-                try:
-                    iscluster_exist = True
-                    #print(f'Cluster {cluster} is exist. Nothing to do')
-                    break
-                except Exception:
-                    print(f'Error!. Error while update VM Cluster. If you want to has detail, watch this: {cluster}')
+#выгрузка читается потоково, кластер за кластером, поэтому ее можно подавать через пайп:
+# get_cluster.py -o - | nb_vm.py --input -
+#или вообще без файла и пайпа, одним процессом: nb_pipeline.py (сбор и заливка идут одновременно)
+#в инкрементальном режиме (get_cluster.py --incremental) в выгрузке лежат только созданные/измененные ВМ
+#(кластеры с full=false) и записи об удаленных ВМ
+
+
+def normalize_name(name):
+    #имена платформ сравниваются без пробелов, как это всегда делал скрипт
+    return str(name).replace(' ', '')
+
+
+def platform_slug(ostype):
+    slug_create = ostype.replace(' ', '')
+    # slug_create = pytils.translit.translify(slug_create)
+    slug_create = slug_create.replace('.', '')
+    slug_create = slug_create.replace("'", '')
+    slug_create = slug_create.replace('(', '')
+    slug_create = slug_create.replace(")", '')
+    # slug_create = slug_create[:100]
+    slug_create = slug_create.replace('"', '')
+    slug_create = slug_create.replace('+', '')
+    slug_create = slug_create.replace('/', '')
+    return slug_create
+
+
+class ReferenceCache(object):
+    #справочники нетбокса (платформы, тенанты, кластеры, типы кластеров), загруженные один раз на прогон
+    #раньше на каждую ВМ делались platforms.all() + platforms.get() + tenants.get() + clusters.get(),
+    #теперь поиск по имени - это обращение к словарю без http запросов
+    #созданные скриптом платформы и кластеры добавляются в кэш на месте
+
+    def __init__(self, nb):
+        self.nb = nb
+        self.lock = threading.Lock()
+        self.platforms = {}
+        self.platforms_by_slug = {}
+        self.tenants = {}
+        self.clusters = {}
+        self.cluster_types = {}
+        for platform in nb.dcim.platforms.all():
+            self.add_platform(platform)
+        for tenant in nb.tenancy.tenants.all():
+            self.tenants[str(tenant.name).strip()] = tenant
+        for cluster in nb.virtualization.clusters.all():
+            self.clusters[str(cluster.name)] = cluster
+        for cluster_type in nb.virtualization.cluster_types.all():
+            self.cluster_types[str(cluster_type.name)] = cluster_type
+
+    def add_platform(self, platform):
+        self.platforms[normalize_name(platform.name)] = platform
+        self.platforms_by_slug[str(platform.slug)] = platform
+
+    def platform(self, name):
+        return self.platforms.get(normalize_name(name))
+
+    def ensure_platform(self, ostype):
+        platform = self.platform(ostype)
+        if platform is not None:
+            #print('OS под названием {} уже существует'.format(ostype))
+            return platform
+        with self.lock:
+            platform = self.platform(ostype)
+            if platform is not None:
+                return platform
+            slug_create = platform_slug(ostype)
+            #платформа с таким же slug может уже существовать под немного другим именем
+            platform = self.platforms_by_slug.get(slug_create)
+            if platform is not None:
+                return platform
+            try:
+                platform = self.nb.dcim.platforms.create(name=str(ostype), slug=str(slug_create))
+                #print(f'This VM Platform is not exist. Create Platform with name: {ostype}')
+                self.add_platform(platform)
+            except Exception:
+                print(f'Error! Error while create VM Platform. If you want to has detail, watch this: {ostype}')
+                print('Error:\n', traceback.format_exc())
+            return platform
+
+    def tenant(self, name):
+        return self.tenants.get(str(name).strip())
+
+    def cluster(self, name):
+        return self.clusters.get(str(name))
+
+    def cluster_type(self, name):
+        return self.cluster_types.get(str(name))
+
+    def ensure_cluster(self, cluster, cluster_type):
+        cluster_get = self.cluster(cluster)
+        if cluster_get is not None:
+            #print(f'Cluster {cluster} is exist. Nothing to do')
+            return cluster_get
+        with self.lock:
+            cluster_get = self.cluster(cluster)
+            if cluster_get is not None:
+                return cluster_get
+            try:
+                cluster_get = self.nb.virtualization.clusters.create(name=str(cluster), type=cluster_type.id)
+                #print(f'This VM Cluster is not exist. Create Cluster with name: {cluster}')
+                self.clusters[str(cluster)] = cluster_get
+            except Exception:
+                print(f'Error! Error while create VM Cluster. If you want to has detail, watch this: {cluster}')
+                print('Error:\n', traceback.format_exc())
+            return cluster_get
+
+
+class RateLimiter(object):
+    #общий на весь прогон ограничитель нагрузки на нетбокс:
+    #не больше rps запросов в секунду (0 - без ограничения) и не больше max_in_flight запросов одновременно
+    #только ограничивает: время ответа и пропускную способность считает api_client.STATS
+
+    def __init__(self, rps=0, max_in_flight=8):
+        self.interval = 1.0 / rps if rps > 0 else 0
+        self.in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        self.in_flight.acquire()
+        if self.interval:
+            #каждый запрос занимает следующий свободный слот по времени и ждет его
+            with self.lock:
+                now = time.monotonic()
+                slot = max(now, self.next_slot)
+                self.next_slot = slot + self.interval
+            if slot > now:
+                time.sleep(slot - now)
+
+    def release(self):
+        self.in_flight.release()
+
+
+class LimitedSession(api_client.ApiSession):
+    #http сессия pynetbox, через которую идут ВСЕ запросы к нетбоксу (и чтение, и запись)
+    #одна на все потоки: пул соединений, gzip и повторы из api_client, а каждая попытка запроса проходит через RateLimiter
+
+    def __init__(self, limiter, pool_size):
+        super().__init__(pool_size=pool_size)
+        self.limiter = limiter
+
+    def attempt(self, *args, **kwargs):
+        self.limiter.acquire()
+        try:
+            return super().attempt(*args, **kwargs)
+        finally:
+            self.limiter.release()
+
+
+class BulkWriter(object):
+    #отправка изменений в один эндпоинт нетбокса пачками через bulk POST/PATCH/DELETE
+    #(эндпоинты virtual-machines и ip-addresses принимают список объектов одним запросом)
+    #если пачка целиком упала (например из-за одной битой записи), она повторяется поштучно,
+    #чтобы одна плохая запись не ломала всю пачку
+    #все методы возвращают список элементов, которые так и не удалось записать
+
+    def __init__(self, endpoint, batch_size=100):
+        self.endpoint = endpoint
+        self.batch_size = max(1, batch_size)
+        self.lock = threading.Lock()
+        #счетчик http запросов на запись, для итоговой статистики
+        self.requests = 0
+
+    def batches(self, items):
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start + self.batch_size]
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def write(self, action, items, describe, results=None):
+        #results - список, в который складываются ответы нетбокса (созданные объекты)
+        failed = []
+        for batch in self.batches(items):
+            try:
+                self.count()
+                result = action(batch)
+                if results is not None:
+                    results.extend(result)
+                continue
+            except Exception:
+                if len(batch) == 1:
+                    failed.extend(batch)
+                    print(f'Error!. Error while write to {self.endpoint.url}. If you want to has detail, watch this: {describe(batch[0])}')
                     print('Error:\n', traceback.format_exc())
-        if not iscluster_exist:
+                    continue
+            for item in batch:
                 try:
-                    nb.virtualization.clusters.create(name=str(cluster), type=cluster_type_dc.id)
-                    #print(f'This VM Cluster is not exist. Create Cluster with name: {cluster}')
+                    self.count()
+                    result = action([item])
+                    if results is not None:
+                        results.extend(result)
                 except Exception:
-                    print(f'Error! Error while create VM Cluster. If you want to has detail, watch this: {cluster}')
+                    failed.append(item)
+                    print(f'Error!. Error while write to {self.endpoint.url}. If you want to has detail, watch this: {describe(item)}')
                     print('Error:\n', traceback.format_exc())
-        #print(cluster)
-        cluster_get = nb.virtualization.clusters.get(name=cluster)
-        vm_all = nb.virtualization.virtual_machines.filter(cluster_id=cluster_get.id)
-        vm_all_tuple = tuple(vm_all)
-        #print(vm_all_tuple)
-
-        for host in templates[dc][cluster]:
-                for vm in templates[dc][cluster][host]:
-                    #далее начинается самое интересное, здесь мы начинаем фиксировать значения переменных,
-                    #которые содержат различную информациию о ВМ, чтобы в дальнейшем нам было чем оперировать
-                    mem = (templates[dc][cluster][host][vm]['mem'])
-                    cpu = (templates[dc][cluster][host][vm]['cpu'])
-                    path = (templates[dc][cluster][host][vm]['path'])
-                    ostype = (templates[dc][cluster][host][vm]['ostype'])
-                    state = (templates[dc][cluster][host][vm]['state'])
-                    diskGBTotal = str(templates[dc][cluster][host][vm]['diskGBTotal'])
-                    annotation = (templates[dc][cluster][host][vm]['annotation'])
-                    netstate = templates[dc][cluster][host][vm]['net']
-                    folder = templates[dc][cluster][host][vm]['folder']
-                    folder = folder.rstrip(' ')
-                    mem_res = templates[dc][cluster][host][vm]['MemoryReservation']
-                    Storage_index_num = templates[dc][cluster][host][vm]['Storage_index_num']
-                    RDM_index_num = templates[dc][cluster][host][vm]['RDM_index_num']
-                    snapshot = templates[dc][cluster][host][vm]['Snapshot']
-                    thinprov = templates[dc][cluster][host][vm]['ThinProv']
-
-                    #определяем состояние переменной State
-                    #данная переменная говорит нам о том, включена или выключена ВМ
-                    if state == 'poweredOn':
-                        status = 'active'
-                    elif state == 'poweredOff':
-                        status = 'offline'
-                    else:
-                        None
-
-                    # аналогично определяем состояние переменной snapshot
-                    # данная переменная говорит нам о том, есть или нет СНАПШОТ на ВМ
-                    if snapshot == 'True':
-                        snapshot = 1
-                    elif snapshot == 'False':
-                        snapshot = 0
-                    else:
-                        None
-
-
-                    if thinprov == 'True':
-                        thinprov = 1
-                    elif thinprov == 'False':
-                        thinprov = 0
-                    else:
-                        None
-
-                    #следующим куском кода мы будем проверять наличие или отсутствие операционной системы на нетбоксе
-                    #http://netbox.dc16.ru/dcim/platforms/
-
-                    isplatform_exist = False
-                    platform_all = nb.dcim.platforms.all()
-                    for nb_platform in platform_all:
-                        try:
-                            name_short_os = str(ostype).replace(' ', '')
-                            name_short_os_nb = str(nb_platform.name).replace(' ', '')
-                            if str(name_short_os_nb) == str(name_short_os):
-                                isplatform_exist = True
-                                #print('OS под названием {} уже существует'.format(ostype))
-                                break
-                        except Exception:
-                            print(f'Error! Error while update VM Platform. If you want to has detail, watch this: {name_short_os}')
-                            print('Error:\n', traceback.format_exc())
-
-                    if not isplatform_exist:
-                        try:
-                            slug_create = ostype.replace(' ', '')
-                            # slug_create = pytils.translit.translify(slug_create)
-                            slug_create = slug_create.replace('.', '')
-                            slug_create = slug_create.replace("'", '')
-                            slug_create = slug_create.replace('(', '')
-                            slug_create = slug_create.replace(")", '')
-                            # slug_create = slug_create[:100]
-                            slug_create = slug_create.replace('"', '')
-                            slug_create = slug_create.replace('+', '')
-                            slug_create = slug_create.replace('/', '')
-                            nb.dcim.platforms.create(name=str(ostype), slug=str(slug_create))
-                            #print(f'This VM Platform is not exist. Create Platform with name: {ostype}')
-                        except Exception:
-                            print(f'Error! Error while create VM Platform. If you want to has detail, watch this: {ostype}')
-                            print('Error:\n', traceback.format_exc())
-
-                    #следующие переменные SSD,SATA...обнуляются т.к. все ВМ имеют разные размеры
-                    #и при каждой новой итерации цикла эти переменные должны быть нулевыми
-                    SSD = 0
-                    SATA = 0
-                    DEPR = 0
-                    SAS = 0
-                    #отдельно следует отметить переменную Unknown, она нужна для того если жесткий диск не попадет ни в один из представленных критериев
-                    #сами критерии выбора будут определены ниже
-                    Unknown = 0
-
-                    #в первую очередь будем исходить из КОЛИЧЕСТВА жестких дисков
-                    #сами диски на вм имеют следующий вид:
-                    #Storage_info_xxx и Storage_TotalDisk_xxx
-                    #где info это путь к датастору (например DC_veeam_v8/DC_veeam_v8.vmdk)
-                    #а TotalDisk это общий объем данного жесткого диска
-                    # соответственно, когда мы начинаем крутить цикл, то просто по очереди перебираем все диски на ВМ
-
-                    dict_for_netbox = []
-
-                    for i in range(Storage_index_num):
-                        dict_for_netbox.append('Storage_{}'.format(i))
-                        dict_for_netbox.append('Storage_volume_{}'.format(i))
-
-                    r1 = dict.fromkeys(dict_for_netbox)
-                    for i in range(Storage_index_num):
-                        current_storage_volume_index = ('Storage_info_{}').format(i)
-                        current_storage_index = ('Storage_TotalDisk_{}').format(i)
-                        #в этом месте мы обращаемся к файлику output.json и записываем в переменную current_storage актуальную инфу о диске
-                        #хз насколько получается понятно, надеюсь вы разберетесь
-                        current_storage_info = templates[dc][cluster][host][vm]['{}'.format(current_storage_volume_index)]
-                        current_storage_total = templates[dc][cluster][host][vm]['{}'.format(current_storage_index)]
-
-                        current_storage_for_nb='Storage_{}'.format(i)
-                        current_volume_for_nb ='Storage_volume_{}'.format(i)
-
-                        r1.update({current_storage_for_nb: current_storage_info})
-                        r1.update({current_volume_for_nb: current_storage_total})
-
-
-                        #в этом месте мы определяем регулярные выражения, которые будут использоваться для выбора принадлежности диска (SAS, SATA, SSD)
-                        # делаем мы это за счет того, что датастор 100% содержит в себе одно из этих слов
-                        #например [DE4K2-SC-SAS4-MinFin] CLNT-SecMinFin-Sec/CLNT-SecMinFin-Sec.vmx
-                        # такой гранулярности нам вполне достаточно чтобы понять к какой категории отнести текущий диск
-                        reg_SSD = re.findall((r'SSD'), current_storage_info)
-                        reg_SATA = re.findall((r'SATA'), current_storage_info)
-                        reg_SAS = re.findall((r'SAS'), current_storage_info)
-
-                        #тут мы ищем совпадения с регулярным выражением
-                        #если совпадения есть, то прибавляем к обнуленной переменной общий объем текущего диска
-                        if len(reg_SATA) != 0:
-                            SATA = SATA + int(float(current_storage_total))
-                        elif len(reg_SAS) != 0:
-                            SAS = SAS + int(float(current_storage_total))
-                        elif len(reg_SSD) != 0:
-                            SSD = SSD + int(float(current_storage_total))
-                        else:
-                            Unknown = Unknown + int(float(current_storage_total))
-
-                    #следующим условием мы отсекаем от общей массы так называемые RDM диски, которые следует учитывать отдельно, т.к
-                    #они НЕ хранятся в переменных вида Storage_info_xxx и Storage_TotalDisk_xxx
-                    #данные переменные имеют следующий вид:
-                    #RDM_DISK_info_xxx и RDM_DISK_Total_xxx
-                    # остальном логика абсолютно идентична предыдущему процессу для обычных жестких дисков
-                    r2 = dict()
-                    if RDM_index_num != 0:
-                        dict_for_netbox_rdm = []
-                        for m in range(RDM_index_num):
-                            dict_for_netbox_rdm.append('Storage_rdm_{}'.format(m))
-                            dict_for_netbox_rdm.append('Storage_volume_rdm{}'.format(m))
-
-                        r2 = dict.fromkeys(dict_for_netbox_rdm)
-
-                        for j in range(RDM_index_num):
-                            # Info - это [V7K4-SAS-1] DC_veeam_v8/DC_veeam_v8.vmdk
-                            RDM_storage_volume_index = ('RDM_DISK_info_{}').format(j)
-                            # Total - это ВЕС в ГБ (51 ГБ)
-                            RDM_storage_index = ('RDM_DISK_Total_{}').format(j)
-                            # в этом месте мы обращаемся к файлику output.json и записываем в переменную current_storage актуальную инфу о диске
-                            rdm_current_storage_info = templates[dc][cluster][host][vm][
-                                '{}'.format(RDM_storage_volume_index)]
-                            rdm_current_storage_total = templates[dc][cluster][host][vm][
-                                '{}'.format(RDM_storage_index)]
-
-                            current_storage_for_nb_rdm = 'Storage_rdm_{}'.format(j)
-                            current_volume_for_nb_rdm = 'Storage_volume_rdm{}'.format(j)
-
-                            r2.update({current_storage_for_nb_rdm: rdm_current_storage_info})
-                            r2.update({current_volume_for_nb_rdm: rdm_current_storage_total})
-
-                            #опять определяем регулярки
-                            reg_SSD = re.findall((r'SSD'), rdm_current_storage_info)
-                            reg_SATA = re.findall((r'SATA'), rdm_current_storage_info)
-                            reg_SAS = re.findall((r'SAS'), rdm_current_storage_info)
-                            #ищем совпадения. если таковые имеются, прибавляем объем диска к одной из переменных (SAS,SATA...)
-                            if len(reg_SATA) != 0:
-                                SATA = SATA + int(float(rdm_current_storage_total))
-                            elif len(reg_SAS) != 0:
-                                SAS = SAS + int(float(rdm_current_storage_total))
-                            elif len(reg_SSD) != 0:
-                                SSD = SSD + int(float(rdm_current_storage_total))
-                            else:
-                                Unknown = Unknown + int(float(rdm_current_storage_total))
-                    #после всех манипуляций с дисками ВМ получаем общую сумму всех жестких дисков
-                    total_disk_gb = int(SAS) + int(SATA) + int(SSD) + int(Unknown)
-                    isvm_exist = False
-                    #выдергиваем с нетбокса платформу, на которой работает ВМ (это нужно для создания новых виртуалок)
-                    platform_current = nb.dcim.platforms.get(name=ostype)
-                    #записываем текущую ВМ в переменную set_vmware_vm (в этот список попадают только те ВМ, которые есть на виртуализации на момент работы скрипта)
-                    set_vmware_vm.add(str(vm))
-
-                    r1.update(r2)
-
-                    for vm_netbox in vm_all_tuple:
-                        #далее мы начинаем прокручивать цикл для ВСЕХ вм которые есть в нетбоксе, чтобы найти или НЕ найти совпадения с текущей ВМ которая была взята с ВМВАРЫ
-                        #в эту переменную set_ipam_vm мы записывыаем текущую ВМ которая была содрана с нетбокса
-                        #зачем это нужно? ответ на этот вопрос будет дан ниже
-                        set_ipam_vm.add(str(vm_netbox))
-                        if str(vm_netbox.name) == str(vm[:64]):
-                            try:
-                                # очень важный момент! метод update в нетбоксе работает ТОЛЬКО со словарями.
-                                # поэтому перед тем, как применять этот метод, я формирую словарь с исходными данными, которые будут заливаться в нетбокс
-                                isvm_exist = True
-                                tenant_for_vm = nb.tenancy.tenants.get(name=str(folder[:30]))
-                                update_dict = dict(
-                                    vcpus=cpu,
-                                    memory=int(float(mem)),
-                                    disk=total_disk_gb,
-                                    tenant=tenant_for_vm,
-                                    platform=platform_current,
-                                    status=str(status)
-                                )
-                                vm_netbox.update({'custom_fields': {'HOST': str(host), 'SAS': int(SAS), 'SSD': int(SSD),
-                                                                    'SATA': int(SATA), 'Unknown': int(Unknown),
-                                                                    'Snapshot': bool(snapshot),
-                                                                    'Thin Provision': bool(thinprov)}})
-                                vm_netbox.update(update_dict)
-                                #print('VM обновлена {}'.format(str(vm)))
-                                break
-                            except Exception:
-                                print(f'Error!. Error while update VM in Cluster. If you want to has detail, watch this: {vm_netbox}')
-                                print('Error:\n', traceback.format_exc())
-
-                    if not isvm_exist:
-                        try:
-                            # в случае, когда вм нужно СОЗДАТЬ, а не обновить, работает практически такая же логика
-                            # только в этот раз словарь мы уже не используем, а передаем аргументы напрямую
-                            tenant_for_netbox = str(((folder[:30]).rstrip(' ')))
-                            tenant_for_vm = nb.tenancy.tenants.get(name=tenant_for_netbox)
-                            cluster_for_vm = nb.virtualization.clusters.get(name=str(cluster))
-                            nb.virtualization.virtual_machines.create(name=str(vm[:64]),
-                                                                      cluster=cluster_for_vm.id,
-                                                                      vcpus=cpu,
-                                                                      memory=int(float(mem)),
-                                                                      disk=total_disk_gb,
-                                                                      platform=platform_current.id,
-                                                                      tenant=tenant_for_vm.id,
-                                                                      status=str(status),
-                                                                      custom_fields={'HOST': str(host), 'SAS': int(SAS),
-                                                                                     'SSD': int(SSD), 'SATA': int(SATA),
-                                                                                     'Unknown': int(Unknown),
-                                                                                     'Snapshot': bool(snapshot),
-                                                                                     'Thin Provision': bool(thinprov)}
-                                                                      )
-                            #print('VM создана {}'.format(str(vm)))
-                        except Exception:
-                            print(f'Error!. Error while create VM in Cluster. If you want to has detail, watch this: {vm[:64]}')
-                            print('Error:\n', traceback.format_exc())
-
-
-        #дальше, после того как все вм на хосту были обработаны, мы имеем 2 списка
-        #set_ipam_vm и set_vmware_vm
-        #первый содержит название всех виртуалок из нетбокса, второй всех вм на виртуализации
-        #применив метод difference_update к одному из списков мы получим разницу, которая будет содержать в себе ВМ, которых нет на вмваре, но есть на нетбоксе
+        return failed
+
+    def create(self, items, created=None):
+        #created - список, в который складываются созданные объекты (с их id)
+        return self.write(self.endpoint.create, items, lambda item: item.get('name', item), created)
+
+    def update(self, items):
+        #каждый элемент - словарь с id объекта и изменяемыми полями; возвращает id неудачных объектов
+        failed = self.write(self.endpoint.update, items, lambda item: item['id'])
+        return [item['id'] for item in failed]
+
+    def delete(self, ids):
+        return self.write(self.endpoint.delete, ids, lambda item: item)
+
+
+class NetboxWriter(object):
+    #писатели для всех эндпоинтов, в которые заливает nb_vm.py
+
+    def __init__(self, nb, batch_size=100):
+        self.nb = nb
+        self.batch_size = batch_size
+        self.vms = BulkWriter(nb.virtualization.virtual_machines, batch_size)
+        self.ips = BulkWriter(nb.ipam.ip_addresses, batch_size)
+
+
+def desired_state(ref, record):
+    #далее начинается самое интересное, здесь мы начинаем фиксировать значения переменных,
+    #которые содержат различную информациию о ВМ, чтобы в дальнейшем нам было чем оперировать
+    #record - запись VMRecord из выгрузки, все поля в ней уже нужных типов
+    #возвращает словарь с полями ВМ в том виде, в котором они заливаются в нетбокс
+    folder = record.folder.rstrip(' ')
+
+    #определяем состояние переменной State
+    #данная переменная говорит нам о том, включена или выключена ВМ
+    if record.state == 'poweredOn':
+        status = 'active'
+    elif record.state == 'poweredOff':
+        status = 'offline'
+    else:
+        status = None
+
+    #следующим куском кода мы будем проверять наличие или отсутствие операционной системы на нетбоксе
+    #http://netbox.dc16.ru/dcim/platforms/
+    #справочник платформ загружен один раз на весь прогон, новая платформа сразу добавляется в кэш
+    platform_current = ref.ensure_platform(record.ostype)
+    tenant_for_vm = ref.tenant(folder[:30])
+
+    #следующие переменные SSD,SATA...обнуляются т.к. все ВМ имеют разные размеры
+    #и при каждой новой итерации цикла эти переменные должны быть нулевыми
+    SSD = 0
+    SATA = 0
+    DEPR = 0
+    SAS = 0
+    #отдельно следует отметить переменную Unknown, она нужна для того если жесткий диск не попадет ни в один из представленных критериев
+    #сами критерии выбора будут определены ниже
+    Unknown = 0
+
+    #в первую очередь будем исходить из КОЛИЧЕСТВА жестких дисков
+    #каждый диск в записи - это путь к датастору (например [V7K4-SAS-1] DC_veeam_v8/DC_veeam_v8.vmdk)
+    #и общий объем данного жесткого диска в ГБ
+    #RDM диски учитываются точно так же, как и обычные (толстые или тонкие)
+    # соответственно, когда мы начинаем крутить цикл, то просто по очереди перебираем все диски на ВМ
+    for disk in record.disks:
+        #в этом месте мы определяем регулярные выражения, которые будут использоваться для выбора принадлежности диска (SAS, SATA, SSD)
+        # делаем мы это за счет того, что датастор 100% содержит в себе одно из этих слов
+        #например [DE4K2-SC-SAS4-MinFin] CLNT-SecMinFin-Sec/CLNT-SecMinFin-Sec.vmx
+        # такой гранулярности нам вполне достаточно чтобы понять к какой категории отнести текущий диск
+        reg_SSD = re.findall((r'SSD'), disk.path)
+        reg_SATA = re.findall((r'SATA'), disk.path)
+        reg_SAS = re.findall((r'SAS'), disk.path)
+
+        #тут мы ищем совпадения с регулярным выражением
+        #если совпадения есть, то прибавляем к обнуленной переменной общий объем текущего диска
+        if len(reg_SATA) != 0:
+            SATA = SATA + disk.size_gb
+        elif len(reg_SAS) != 0:
+            SAS = SAS + disk.size_gb
+        elif len(reg_SSD) != 0:
+            SSD = SSD + disk.size_gb
+        else:
+            Unknown = Unknown + disk.size_gb
+
+    #после всех манипуляций с дисками ВМ получаем общую сумму всех жестких дисков
+    total_disk_gb = int(SAS) + int(SATA) + int(SSD) + int(Unknown)
+
+    custom_fields = {'HOST': str(record.host), 'SAS': int(SAS), 'SSD': int(SSD),
+                     'SATA': int(SATA), 'Unknown': int(Unknown),
+                     'Snapshot': bool(record.snapshot),
+                     'Thin Provision': bool(record.thin_provisioned)}
+    if UUID_FIELD and record.instance_uuid:
+        custom_fields[UUID_FIELD] = record.instance_uuid
+    state = dict(
+        name=str(record.name[:64]),
+        vcpus=record.cpu,
+        memory=int(record.mem_gb),
+        disk=total_disk_gb,
+        tenant=tenant_for_vm.id if tenant_for_vm else None,
+        platform=platform_current.id if platform_current else None,
+        custom_fields=custom_fields
+    )
+    #неизвестное состояние (например suspended) в нетбоксе не трогаем
+    if status:
+        state['status'] = status
+    return state
+
+
+class ClusterPlan(object):
+    #план синхронизации одного кластера: какие ВМ создать, какие обновить и какие удалить
+    #create - [VMRecord], update - [(ВМ нетбокса, VMRecord)], delete - [ВМ нетбокса]
+
+    def __init__(self, cluster_get):
+        self.cluster = cluster_get
+        self.create = []
+        self.update = []
+        self.delete = []
+        #счетчики исполнения плана: сколько ВМ реально обновлено и сколько записей пропущено без изменений
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        #сколько ВМ этого кластера было в нетбоксе (для защиты от массового удаления), 0 - если кластер выгружен не полностью
+        self.known = 0
+        #{имя ВМ: id в нетбоксе} для ВМ, состояние которых после исполнения плана совпадает с нетбоксом
+        self.synced = {}
+
+
+def plan_cluster(cluster_get, records, vm_all, full=True):
+    #сопоставляем ВМ с виртуализации с ВМ нетбокса за линейное время
+    #раньше для каждой ВМ с вмвары прокручивался цикл по ВСЕМ вм кластера в нетбоксе (O(N^2))
+    #теперь ВМ нетбокса один раз раскладываются в словари по имени (обрезанному до 64 символов, как в нетбоксе)
+    #и, если в конфиге задано поле для uuid, по instance uuid вмвары - так находится переименованная ВМ
+    plan = ClusterPlan(cluster_get)
+    by_name = {}
+    by_uuid = {}
+    for vm_netbox in vm_all:
+        by_name[str(vm_netbox.name)] = vm_netbox
+        if UUID_FIELD:
+            vm_uuid = (vm_netbox.custom_fields or {}).get(UUID_FIELD)
+            if vm_uuid:
+                by_uuid[vm_uuid] = vm_netbox
+
+    #сначала сопоставляем по имени, затем оставшиеся ВМ - по uuid среди еще не занятых ВМ нетбокса
+    matched = set()
+    unmatched = []
+    for record in records:
+        vm_netbox = by_name.get(str(record.name[:64]))
+        if vm_netbox is None or vm_netbox.id in matched:
+            unmatched.append(record)
+        else:
+            matched.add(vm_netbox.id)
+            plan.update.append((vm_netbox, record))
+    for record in unmatched:
+        vm_netbox = by_uuid.get(record.instance_uuid) if record.instance_uuid else None
+        if vm_netbox is None or vm_netbox.id in matched:
+            plan.create.append(record)
+        else:
+            #ВМ переименовали на вмваре - обновляем существующую запись вместе с именем
+            matched.add(vm_netbox.id)
+            plan.update.append((vm_netbox, record))
+
+    #в инкрементальном режиме в кластере лежат только измененные ВМ,
+    #поэтому вычислять по ним кандидатов на удаление нельзя - удаленные ВМ приходят отдельным списком
+    if full:
         #например: раньше на вмваре была vm под названием test_xxx. после прогона скрипта она была занесена в нетбокс
         #но в один из дней эту ВМ удалили, и получается так что её уже нет на виртуализации, но она есть в нетбоксе.
-        #именно эту разницу мы и пытаемся отловить с помощью метода difference_update
-        new_set=set_ipam_vm.difference(set_vmware_vm)
-        #цикл представленный ниже мы будем прогонять для всех кандитатов на удаление в полученном списке
-        for removal_сandidate in new_set:
+        #именно такие ВМ и остаются несопоставленными
+        plan.delete = [vm_netbox for vm_netbox in vm_all if vm_netbox.id not in matched]
+    return plan
+
+
+#числовые поля ВМ: нетбокс может вернуть vcpus как 2.0 или "2.00", поэтому сравниваем как числа
+NUMERIC_FIELDS = ('vcpus', 'memory', 'disk')
+
+
+def current_value(value):
+    #приводим значение поля ВМ из нетбокса к виду, в котором мы его заливаем:
+    #вложенные объекты (tenant, platform) - к id, choice поля (status) - к value
+    if isinstance(value, dict):
+        return value.get('id', value.get('value'))
+    if hasattr(value, 'id'):
+        return value.id
+    if hasattr(value, 'value'):
+        return value.value
+    return value
+
+
+def diff_vm(vm_netbox, desired):
+    #сравниваем желаемое состояние ВМ с тем, что уже лежит в нетбоксе
+    #возвращает словарь только с отличающимися полями (пустой, если ВМ не изменилась)
+    patch = {}
+    for field, value in desired.items():
+        if field == 'custom_fields':
+            continue
+        current = current_value(getattr(vm_netbox, field, None))
+        if field in NUMERIC_FIELDS and current is not None and value is not None:
+            try:
+                if float(current) == float(value):
+                    continue
+            except (TypeError, ValueError):
+                pass
+        elif current == value:
+            continue
+        patch[field] = value
+    current_fields = dict(getattr(vm_netbox, 'custom_fields', None) or {})
+    if any(current_fields.get(field) != value for field, value in desired['custom_fields'].items()):
+        #custom fields отправляем целиком (с нашими изменениями поверх текущих),
+        #чтобы не зависеть от того, как версия нетбокса мержит частичный словарь
+        current_fields.update(desired['custom_fields'])
+        patch['custom_fields'] = current_fields
+    return patch
+
+
+def apply_plan(writer, ref, plan):
+    #исполняем план синхронизации кластера
+    #все изменения собираются в списки и уходят в нетбокс пачками через bulk эндпоинты (см. BulkWriter)
+    updates = []
+    for vm_netbox, record in plan.update:
+        try:
+            # очень важный момент! метод update в нетбоксе работает ТОЛЬКО со словарями.
+            # раньше на каждую ВМ уходило два PATCH запроса (custom fields и остальные поля), даже если ничего не поменялось
+            # теперь формируем словарь только из отличающихся полей, а неизмененные ВМ пропускаем
+            patch = diff_vm(vm_netbox, desired_state(ref, record))
+        except Exception:
+            print(f'Error!. Error while update VM in Cluster. If you want to has detail, watch this: {vm_netbox}')
+            print('Error:\n', traceback.format_exc())
+            continue
+        if not patch:
+            plan.skipped += 1
+            plan.synced[str(record.name[:64])] = vm_netbox.id
+            continue
+        patch['id'] = vm_netbox.id
+        updates.append(patch)
+    failed = set(writer.vms.update(updates))
+    plan.updated = len(updates) - len(failed)
+    for vm_netbox, record in plan.update:
+        if str(record.name[:64]) not in plan.synced and vm_netbox.id not in failed:
+            plan.synced[str(record.name[:64])] = vm_netbox.id
+
+    # в случае, когда вм нужно СОЗДАТЬ, а не обновить, работает практически такая же логика
+    creates = []
+    for record in plan.create:
+        try:
+            creates.append(dict(cluster=plan.cluster.id, **desired_state(ref, record)))
+        except Exception:
+            print(f'Error!. Error while create VM in Cluster. If you want to has detail, watch this: {record.name[:64]}')
+            print('Error:\n', traceback.format_exc())
+    created = []
+    writer.vms.create(creates, created)
+    plan.created = len(created)
+    for vm_netbox in created:
+        plan.synced[str(vm_netbox.name)] = vm_netbox.id
+    #кандидаты на удаление (plan.delete) здесь не трогаем - они удаляются в конце прогона
+    #одним общим этапом decommission, после проверки на подозрительно большой объем удаления
+
+
+def ip_vm_id(ip):
+    #id ВМ, к интерфейсу которой привязан ip адрес (None, если по ответу нетбокса это не определить)
+    try:
+        return ip.assigned_object.virtual_machine.id
+    except AttributeError:
+        return None
+
+
+#сколько id или имен передавать в одном фильтре (ограничение на длину url)
+FILTER_CHUNK = 200
+
+
+def decommission(writer, vms):
+    #удаление ВМ, которых больше нет на виртуализации, возвращает список id удаленных ВМ
+    # зачем нужно сначала отвязывать ip: при удалении ВМ нетбокс удаляет ВСЕ связанные с данной ВМ объекты, включая интерфейсы и даже ip адреса
+    # ip адреса удалять не нужно, потому что там иногда содержатся очень важные сведения (description)
+    # поэтому мы сначала отделяем зерна от плевел, и со спокойной душой удяляем ВМ
+    if not vms:
+        return []
+    names = {vm.id: str(vm.name) for vm in vms}
+    vm_ids = list(names)
+    # выдергиваем из нетбокса ip адреса ВСЕХ удаляемых ВМ: один постраничный запрос на каждые FILTER_CHUNK ВМ
+    ip_removal = []
+    keep = set()
+    for start in range(0, len(vm_ids), FILTER_CHUNK):
+        chunk = vm_ids[start:start + FILTER_CHUNK]
+        try:
+            ip_removal.extend(writer.nb.ipam.ip_addresses.filter(virtual_machine_id=chunk))
+        except Exception:
+            #не знаем, какие ip висят на этих ВМ - значит и удалять их нельзя
+            print(f'Error!. Error while fetch IP addresses of removed VMs. If you want to has detail, watch this: {", ".join(names[vm_id] for vm_id in chunk)}')
+            print('Error:\n', traceback.format_exc())
+            keep.update(chunk)
+    owners = {ip.id: ip_vm_id(ip) for ip in ip_removal}
+    #отвязываем все ip одной серией bulk PATCH
+    failed_ips = writer.ips.update([dict(id=ip.id, assigned_object_id=0) for ip in ip_removal])
+    #ВМ, у которых не удалось отвязать ip, не удаляем, чтобы не потерять адреса
+    keep.update(owners[ip_id] for ip_id in failed_ips)
+    if None in keep:
+        #не смогли понять, чей это ip - не рискуем и не удаляем ничего
+        keep = set(vm_ids)
+    for vm_id in keep:
+        print(f'Error!. Error while delete VM in Cluster. If you want to has detail, watch this: {names[vm_id]}')
+    delete_ids = [vm_id for vm_id in vm_ids if vm_id not in keep]
+    #print('удаляю ', delete_ids)
+    failed = set(writer.vms.delete(delete_ids))
+    return [vm_id for vm_id in delete_ids if vm_id not in failed]
+
+
+def removal_allowed(candidates, known, max_delete, max_delete_percent):
+    #защита от массового удаления: если виртуализация отдала неполный инвентарь (например не прочитался весь vCenter),
+    #почти все ВМ нетбокса выглядят удаленными. в этом случае лучше не удалять ничего и разобраться руками
+    #known - сколько ВМ было в нетбоксе в полностью выгруженных кластерах, max_* = 0 отключает соответствующую проверку
+    if max_delete and candidates > max_delete:
+        print(f'Error! {candidates} VMs to remove is more than --max-delete {max_delete}, removal aborted')
+        return False
+    if max_delete_percent and known and candidates * 100 > known * max_delete_percent:
+        print(f'Error! {candidates} of {known} VMs to remove is more than --max-delete-percent {max_delete_percent}%, '
+              f'removal aborted')
+        return False
+    return True
+
+
+def fetch_vms(nb, cluster_get, ids, names):
+    #ВМ кластера в нетбоксе по списку id и по списку имен (фильтры пачками, чтобы не упереться в длину url)
+    vms = {}
+    for start in range(0, len(ids), FILTER_CHUNK):
+        for vm_netbox in nb.virtualization.virtual_machines.filter(id=ids[start:start + FILTER_CHUNK]):
+            vms[vm_netbox.id] = vm_netbox
+    for start in range(0, len(names), FILTER_CHUNK):
+        for vm_netbox in nb.virtualization.virtual_machines.filter(name=names[start:start + FILTER_CHUNK],
+                                                                   cluster_id=cluster_get.id):
+            vms[vm_netbox.id] = vm_netbox
+    #ВМ, которую руками перенесли в другой кластер, этот кластер больше не касается
+    return [vm_netbox for vm_netbox in vms.values() if getattr(vm_netbox.cluster, 'id', None) == cluster_get.id]
+
+
+def sync_cluster(nb, ref, writer, cluster, hosts, full=True, store=None, verify=True):
+    #store - FingerprintStore (или None), verify=True - полная сверка кластера с нетбоксом
+    cluster_get = ref.ensure_cluster(cluster, ref.cluster_type(''))
+    records = [record for host in hosts for record in hosts[host].values()]
+    fingerprints = {}
+    if store is not None:
+        for record in records:
+            fingerprints[str(record.name[:64])] = fingerprint(desired_state(ref, record))
+
+    if store is None or verify:
+        #все ВМ кластера в нетбоксе забираются одним запросом (постранично) и индексируются в plan_cluster
+        vm_all = list(nb.virtualization.virtual_machines.filter(cluster_id=cluster_get.id))
+        plan = plan_cluster(cluster_get, records, vm_all, full=full)
+        plan.known = len(vm_all) if full else 0
+    else:
+        #в нетбокс идем только за измененными, новыми и пропавшими ВМ, остальные пропускаем по отпечатку
+        stored = store.cluster(cluster)
+        changed = [record for record in records
+                   if stored.get(str(record.name[:64]), (None, None))[0] != fingerprints[str(record.name[:64])]]
+        vanished = [name for name in stored if name not in fingerprints] if full else []
+        ids = [stored[name][1] for name in vanished if stored[name][1]]
+        names = []
+        for record in changed:
+            netbox_id = stored.get(str(record.name[:64]), (None, None))[1]
+            if netbox_id:
+                ids.append(netbox_id)
+            else:
+                names.append(str(record.name[:64]))
+        vm_all = fetch_vms(nb, cluster_get, ids, names) if ids or names else []
+        plan = plan_cluster(cluster_get, changed, vm_all, full=full)
+        plan.skipped = len(records) - len(changed)
+        plan.known = len(stored) if full else 0
+        #пропавшие ВМ, которых нет и в нетбоксе, из состояния просто выбрасываем
+        found = {vm_netbox.id for vm_netbox in vm_all}
+        store.forget(cluster, [name for name in vanished if stored[name][1] not in found])
+
+    apply_plan(writer, ref, plan)
+    if store is not None:
+        store.save(cluster, [(name, fingerprints[name], netbox_id) for name, netbox_id in plan.synced.items()
+                             if name in fingerprints], replace=verify and full)
+    return plan
+
+
+def iter_records(path):
+    #генератор: по одной записи выгрузки на строку, весь файл в память не загружается
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def iter_clusters(records):
+    #собираем из потока записей кластеры целиком: запись kind=cluster и следующие за ней записи kind=vm
+    #отдает ('cluster', запись кластера, {host: {vm: {...}}}, сколько ВМ реально дочитано),
+    #('removed', запись) и ('end', запись)
+    current = None
+    for record in records:
+        if record['kind'] == 'vm':
+            header, hosts, count = current
+            try:
+                vm = VMRecord.from_dict(record)
+            except ValueError as error:
+                #битая запись не попадает в кластер, из-за расхождения счетчика удаление по нему не запустится
+                print(f'Error! {error}')
+                continue
+            hosts.setdefault(vm.host, {})[vm.name] = vm
+            current = (header, hosts, count + 1)
+            continue
+        if current is not None:
+            yield ('cluster',) + current
+            current = None
+        if record['kind'] == 'cluster':
+            current = (record, {host: {} for host in record['hosts']}, 0)
+        else:
+            yield record['kind'], record
+    if current is not None:
+        yield ('cluster',) + current
+
+
+def find_removed(nb, ref, removed):
+    #ВМ нетбокса по записям об удаленных ВМ: один запрос с фильтром по списку имен на каждый кластер
+    by_cluster = {}
+    for record in removed:
+        by_cluster.setdefault(record['cluster'], []).append(str(record['name'][:64]))
+    vms = []
+    for cluster, names in by_cluster.items():
+        cluster_get = ref.cluster(cluster)
+        if cluster_get is None:
+            continue
+        for start in range(0, len(names), FILTER_CHUNK):
+            vms.extend(nb.virtualization.virtual_machines.filter(name=names[start:start + FILTER_CHUNK],
+                                                                 cluster_id=cluster_get.id))
+    return vms
+
+
+def sync_stream(nb, ref, writer, records, workers=1, max_delete=0, max_delete_percent=0, store=None, verify=True):
+    #основной цикл заливки: кластеры обрабатываются по мере того, как они приходят в выгрузке
+    #каждый кластер синхронизируется целиком в одном потоке пула, разные кластеры заливаются параллельно
+    #удаление ВМ идет отдельным этапом в конце, когда известен весь список кандидатов
+    complete = False
+    failed = []
+    #failed_clusters - кластеры, которые не удалось залить; interrupted - выгрузка оборвалась без записи end
+    #в обоих случаях часть изменений не попала в нетбокс, и состояние инкрементального режима сохранять нельзя
+    totals = {'created': 0, 'updated': 0, 'skipped': 0, 'deleted': 0, 'complete': False,
+              'failed_clusters': [], 'interrupted': False}
+    candidates = []
+    known = [0]
+    removed = []
+    pending = set()
+    clusters = {}
+
+    def collect(done):
+        for future in done:
+            cluster = clusters.pop(future)
             try:
-                #print(removal_сandidate)
-                # выдергиваем из нетбокса объект ВМ, который в дальнейшем надо будет удалить
-                delete_vm_netbox = nb.virtualization.virtual_machines.get(name=removal_сandidate, cluster_id=cluster_get.id)
-                #print(delete_vm_netbox)
-                # выдергиваем из нетбокса ip адреса, которые связаны с этой удаляемой ВМ
-                ip_removal = nb.ipam.ip_addresses.filter(virtual_machine=str(removal_сandidate))
-                # и далее для каждого ip подходящего под эти условия прогоняем цикл
-                for every_ip in ip_removal:
-                    # двумя следующими действиями мы УДАЛЯЕМ вм из объекта ip address
-                    # зачем это нужно: при удалении ВМ нетбокс удаляет ВСЕ связанные с данной ВМ объекты, включая интерфейсы и даже ip адреса
-                    # ip адреса удалять не нужно, потому что там иногда содержатся очень важные сведения (description)
-                    # поэтому мы сначала отделяем зерна от плевел, и со спокойной душой удяляем ВМ
-                    update_dict = dict(assigned_object_id=0)
-                    every_ip.update(update_dict)
-                #print('удаляю ', delete_vm_netbox)
-                delete_vm_netbox.delete()
+                plan = future.result()
             except Exception:
-                print(f'Error!. Error while delete VM in Cluster. If you want to has detail, watch this: {removal_сandidate}')
+                print(f'Error! Error while sync VM Cluster {cluster}')
                 print('Error:\n', traceback.format_exc())
-
-            #весь процесс повторяется для ВСЕХ хостов, всех кластеров, всех ДЦ
-
-print("--- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+                totals['failed_clusters'].append(cluster)
+                continue
+            totals['created'] += plan.created
+            totals['updated'] += plan.updated
+            totals['skipped'] += plan.skipped
+            candidates.extend(plan.delete)
+            known[0] += plan.known
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for item in iter_clusters(records):
+            if item[0] == 'cluster':
+                header, hosts, count = item[1:]
+                full = header['full']
+                if full and count != header['vms']:
+                    #выгрузка оборвалась посреди кластера, удалять по неполному списку ВМ нельзя
+                    print(f'Error! Cluster {header["cluster"]} is incomplete ({count} of {header["vms"]} VMs), skip removal')
+                    full = False
+                #не читаем выгрузку дальше, пока в очереди слишком много кластеров - держим в памяти только их
+                if len(pending) >= 2 * max(1, workers):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(sync_cluster, nb, ref, writer, header['cluster'], hosts, full, store, verify)
+                clusters[future] = header['cluster']
+                pending.add(future)
+                #весь процесс повторяется для ВСЕХ хостов, всех кластеров, всех ДЦ
+            elif item[0] == 'removed':
+                #ВМ, удаленные на виртуализации с прошлого инкрементального прогона
+                removed.append(item[1])
+            elif item[0] == 'end':
+                complete = True
+                failed = item[1].get('failed') or []
+                if failed:
+                    print(f'Error! vCenters failed during collection: {", ".join(failed)}')
+        collect(wait(pending).done)
+    if removed:
+        try:
+            candidates.extend(find_removed(nb, ref, removed))
+        except Exception:
+            print('Error! Error while fetch removed VMs')
+            print('Error:\n', traceback.format_exc())
+            totals['failed_clusters'].extend(sorted(set(record['cluster'] for record in removed)))
+    if not complete:
+        print('Error! Inventory stream ended without end record, collection was interrupted')
+    totals['interrupted'] = not complete
+    if totals['failed_clusters']:
+        print(f'Error! Clusters failed during sync: {", ".join(totals["failed_clusters"])}')
+    #прогон считается полным, только если выгрузка дочитана до конца, все вцентры выгрузились и все кластеры залиты
+    totals['complete'] = complete and not failed and not totals['failed_clusters']
+    #этап decommission: удаленные ВМ удаляются в конце прогона одной серией пачек
+    if candidates and removal_allowed(len(candidates), known[0], max_delete, max_delete_percent):
+        deleted = decommission(writer, candidates)
+        totals['deleted'] = len(deleted)
+        if store is not None:
+            store.forget_ids(deleted)
+    print(f'VMs created: {totals["created"]}, updated: {totals["updated"]}, '
+          f'deleted: {totals["deleted"]}, unchanged (writes skipped): {totals["skipped"]}')
+    return totals
+
+
+def add_sync_args(parser, workers_option='--workers'):
+    #параметры заливки, общие для nb_vm.py и nb_pipeline.py
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='сколько объектов отправлять в нетбокс одним bulk запросом')
+    parser.add_argument(workers_option, dest='sync_workers', type=int, default=4,
+                        help='сколько кластеров заливать параллельно')
+    parser.add_argument('--rps', type=float, default=20,
+                        help='максимум запросов к нетбоксу в секунду на весь прогон, 0 - без ограничения')
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                        help='максимум одновременных запросов к нетбоксу')
+    parser.add_argument('--max-delete', type=int, default=500,
+                        help='не удалять ничего, если кандидатов на удаление больше, 0 - без ограничения')
+    parser.add_argument('--max-delete-percent', type=float, default=10,
+                        help='не удалять ничего, если кандидатов больше этого процента ВМ в выгруженных кластерах, '
+                             '0 - без ограничения')
+    parser.add_argument('--state-db', default=None,
+                        help='sqlite файл с отпечатками залитых ВМ: неизмененные ВМ пропускаются без запросов в нетбокс')
+    parser.add_argument('--full-verify', action='store_true',
+                        help='сверить с нетбоксом все ВМ, даже неизмененные (ловит ручные правки в нетбоксе)')
+    parser.add_argument('--verify-hours', type=float, default=24,
+                        help='автоматически делать полную сверку, если последняя была раньше, чем столько часов назад')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Заливка ВМ из output.ndjson в нетбокс')
+    parser.add_argument('--input', default='output.ndjson',
+                        help='файл с выгрузкой get_cluster.py, "-" - читать из stdin')
+    add_sync_args(parser)
+    return parser.parse_args()
+
+
+def run_sync(args, records):
+    #заливка потока записей в нетбокс, records - любой итератор записей выгрузки (файл, stdin или сам сборщик)
+    #одна сессия с пулом соединений на все потоки, через нее же работает ограничение нагрузки
+    limiter = RateLimiter(args.rps, args.max_in_flight)
+    nb = api_client.netbox(config.netbox_url, config.netbox_token,
+                           private_key_file=config.private_key_file_path,
+                           session=LimitedSession(limiter, max(args.sync_workers, args.max_in_flight)))
+
+    #все справочники загружаются один раз на весь прогон
+    ref = ReferenceCache(nb)
+
+    writer = NetboxWriter(nb, args.batch_size)
+
+    store = FingerprintStore(args.state_db) if args.state_db else None
+    verify = True
+    if store is not None:
+        verify = args.full_verify or time.time() - store.last_full_verify() > args.verify_hours * 3600
+        if verify:
+            print('Full verify: all VMs are compared with NetBox')
+
+    try:
+        totals = sync_stream(nb, ref, writer, records, workers=args.sync_workers,
+                             max_delete=args.max_delete, max_delete_percent=args.max_delete_percent,
+                             store=store, verify=verify)
+        if store is not None and verify and totals['complete']:
+            store.mark_full_verify()
+    finally:
+        if store is not None:
+            store.close()
+    print(f'NetBox write requests: {writer.vms.requests + writer.ips.requests}')
+    print(api_client.report())
+    return totals
+
+
+def main():
+    start_time = time.time()
+    args = get_args()
+
+    totals = run_sync(args, iter_records(args.input))
+
+    print("--- %s seconds ---" % (time.time() - start_time))
+    #ненулевой код выхода, если часть изменений не залита: по нему не подтверждается состояние
+    #инкрементального режима (get_cluster.py --commit-state)
+    if totals['failed_clusters'] or totals['interrupted']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#модель записи о ВМ, общая для get_cluster.py (сборщик) и nb_vm.py (заливка в нетбокс)
+#раньше диски и сетевые адаптеры лежали в выгрузке плоскими ключами Storage_info_0, RDM_DISK_Total_0,
+#network_adapter_0 со счетчиками *_index_num, а размеры дисков - строками вида "50.00"
+#теперь это типизированные списки с числовыми размерами, а сама запись - NamedTuple (компактный, без __dict__)
+
+from typing import List, NamedTuple, Optional
+
+
+class Disk(NamedTuple):
+    #путь к файлу диска на датасторе, например [V7K4-SAS-1] DC_veeam_v8/DC_veeam_v8.vmdk
+    path: str
+    #объем диска в ГБ (целых)
+    size_gb: int
+    #RDM диск (independent_persistent)
+    rdm: bool
+
+
+class GuestNic(NamedTuple):
+    #сетевой адаптер по данным vmware tools (guest.net), у выключенных ВМ и ВМ без тулзов список пустой
+    mac: str
+    network: str
+    ipv4: List[str]
+    prefix: Optional[int]
+    connected: bool
+
+
+class VMRecord(NamedTuple):
+    dc: str
+    cluster: str
+    host: str
+    name: str
+    folder: str
+    cpu: int
+    #оперативная память в ГБ
+    mem_gb: float
+    #сумма committed + uncommitted по данным vCenter, ГБ
+    disk_total_gb: int
+    path: str
+    ostype: str
+    #poweredOn / poweredOff / suspended
+    state: str
+    annotation: str
+    total_nics: int
+    thin_provisioned: bool
+    memory_reservation: bool
+    snapshot: bool
+    disks: List[Disk]
+    #мак адреса сетевых адаптеров из конфигурации ВМ
+    nics: List[str]
+    guest_net: List[GuestNic]
+    #instance uuid ВМ в vCenter, не меняется при переименовании
+    #в старых выгрузках поля нет, поэтому у него значение по умолчанию
+    instance_uuid: str = ''
+
+    def to_dict(self):
+        #компактное представление для выгрузки: вложенные записи сериализуются списками, а не словарями
+        record = self._asdict()
+        record['disks'] = [list(disk) for disk in self.disks]
+        record['guest_net'] = [list(nic) for nic in self.guest_net]
+        return record
+
+    @classmethod
+    def from_dict(cls, record):
+        #обратное преобразование с проверкой типов, лишние ключи (kind и т.п.) игнорируются
+        #при битой записи кидает ValueError
+        try:
+            values = {field: record[field] for field in cls._fields if field not in cls._field_defaults}
+            values.update({field: record.get(field, default) for field, default in cls._field_defaults.items()})
+            values['disks'] = [Disk(*disk) for disk in record['disks']]
+            values['guest_net'] = [GuestNic(*nic) for nic in record['guest_net']]
+        except (KeyError, TypeError) as error:
+            raise ValueError(f'Invalid VM record {record.get("name")!r}: {error!r}')
+        for field, field_type in FIELD_TYPES.items():
+            if not isinstance(values[field], field_type):
+                raise ValueError(f'Invalid VM record {record.get("name")!r}: '
+                                 f'{field}={values[field]!r} is not {field_type}')
+        for disk in values['disks']:
+            if not isinstance(disk.path, str) or not isinstance(disk.size_gb, int) or disk.size_gb < 0:
+                raise ValueError(f'Invalid VM record {record.get("name")!r}: bad disk {disk!r}')
+        return cls(**values)
+
+
+#ожидаемые типы простых полей VMRecord для проверки при загрузке
+#bool является подклассом int, поэтому для числовых полей он тоже пройдет - это не страшно
+FIELD_TYPES = {
+    'dc': str,
+    'cluster': str,
+    'host': str,
+    'name': str,
+    'folder': str,
+    'cpu': int,
+    'mem_gb': (int, float),
+    'disk_total_gb': int,
+    'path': str,
+    'ostype': str,
+    'state': str,
+    'annotation': str,
+    'total_nics': int,
+    'thin_provisioned': bool,
+    'memory_reservation': bool,
+    'snapshot': bool,
+    'nics': list,
+    'instance_uuid': str,
+}
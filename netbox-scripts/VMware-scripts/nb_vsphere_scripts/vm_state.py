@@ -0,0 +1,65 @@
+#локальное состояние nb_vm.py между прогонами (sqlite)
+#для каждой ВМ хранится отпечаток (хэш) того состояния, которое последний раз было залито в нетбокс, и id ВМ в нетбоксе
+#если на следующем прогоне отпечаток ВМ не изменился, ВМ пропускается целиком - в нетбокс по ней не уходит ни одного запроса
+#ручные правки в нетбоксе так не видны, поэтому периодически нужен полный прогон со сверкой (--full-verify)
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def fingerprint(desired):
+    #хэш желаемого состояния ВМ (словарь из nb_vm.desired_state), не зависит от порядка ключей
+    return hashlib.sha1(json.dumps(desired, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class FingerprintStore(object):
+    #одно соединение на все потоки заливки, доступ через блокировку
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS vms ('
+                            'cluster TEXT NOT NULL, name TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+                            'netbox_id INTEGER, PRIMARY KEY (cluster, name))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS vms_netbox_id ON vms (netbox_id)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def cluster(self, cluster):
+        #{имя ВМ: (отпечаток, id в нетбоксе)} для всех ВМ кластера
+        with self.lock:
+            rows = self.db.execute('SELECT name, fingerprint, netbox_id FROM vms WHERE cluster = ?',
+                                   (cluster,)).fetchall()
+        return {name: (vm_fingerprint, netbox_id) for name, vm_fingerprint, netbox_id in rows}
+
+    def save(self, cluster, vms, replace=False):
+        #vms - [(имя, отпечаток, id в нетбоксе)]; replace=True - кластер сверен целиком, старые записи выбрасываем
+        with self.lock, self.db:
+            if replace:
+                self.db.execute('DELETE FROM vms WHERE cluster = ?', (cluster,))
+            self.db.executemany('INSERT OR REPLACE INTO vms (cluster, name, fingerprint, netbox_id) '
+                                'VALUES (?, ?, ?, ?)', [(cluster,) + tuple(vm) for vm in vms])
+
+    def forget(self, cluster, names):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM vms WHERE cluster = ? AND name = ?', [(cluster, name) for name in names])
+
+    def forget_ids(self, netbox_ids):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM vms WHERE netbox_id = ?', [(netbox_id,) for netbox_id in netbox_ids])
+
+    def last_full_verify(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'last_full_verify'").fetchone()
+        return float(row[0]) if row else 0.0
+
+    def mark_full_verify(self):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_full_verify', ?)",
+                            (str(time.time()),))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,212 @@
+#общая фабрика клиентов нетбокса/наутобота для всех скриптов netbox-scripts
+#раньше каждый скрипт собирал клиент по-своему: create_vlan.py создавал новый pynetbox.api (с подгрузкой приватного ключа)
+#в каждом воркере, get_cluster.py и nb_vm.py - по клиенту без пула, и только test увеличивал пул соединений
+#здесь клиент создается один раз на процесс и переиспользуется всеми потоками:
+# - одна http сессия с пулом keep-alive соединений (tls рукопожатие не на каждый запрос)
+# - gzip ответов
+# - размер страницы для всех списочных запросов (параметр limit)
+# - повтор с паузой на 429 и 5xx (POST на 5xx не повторяется - объект мог успеть создаться)
+# - счетчики запросов и гистограммы времени ответа по каждому эндпоинту (STATS, report())
+#
+#подключение из скрипта (путь к каталогу netbox-scripts относительно самого скрипта):
+# sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# import api_client
+# nb = api_client.netbox(config.netbox_url, config.netbox_token, private_key_file=config.private_key_file_path)
+
+import os
+import re
+import threading
+import time
+import requests
+
+#методы, которые можно безопасно повторить после 5xx или обрыва соединения
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE'])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+#границы корзин гистограммы времени ответа, мс
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def endpoint_name(method, url):
+    #ключ статистики: метод и путь без хоста, query и id объектов, например GET /api/dcim/devices/{id}/
+    path = url.split('://', 1)[-1]
+    path = path[path.find('/'):] if '/' in path else '/'
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', path.split('?', 1)[0])
+    return f'{method} {path}'
+
+
+class ApiStats(object):
+    #счетчики и гистограммы по эндпоинтам, общие для всех потоков процесса
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.started = time.monotonic()
+
+    def record(self, method, url, status, latency):
+        name = endpoint_name(method, url)
+        ms = latency * 1000
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                bucket = index
+                break
+        with self.lock:
+            stats = self.endpoints.get(name)
+            if stats is None:
+                stats = self.endpoints[name] = {'requests': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0,
+                                                'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['requests'] += 1
+            stats['total_ms'] += ms
+            stats['histogram'][bucket] += 1
+            if status is None or status >= 400:
+                stats['errors'] += 1
+
+    def retried(self, method, url):
+        with self.lock:
+            stats = self.endpoints.get(endpoint_name(method, url))
+            if stats is not None:
+                stats['retries'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(stats, histogram=list(stats['histogram'])) for name, stats in self.endpoints.items()}
+
+    def percentile(self, histogram, percent):
+        #оценка перцентиля по гистограмме: верхняя граница корзины, в которую он попал
+        total = sum(histogram)
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if seen * 100 >= total * percent:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float('inf')
+        return 0
+
+    def summary(self):
+        #итог по всем эндпоинтам: количество запросов, пропускная способность и перцентили времени ответа
+        endpoints = self.snapshot().values()
+        requests_count = sum(stats['requests'] for stats in endpoints)
+        if not requests_count:
+            return 'Requests: 0'
+        histogram = [sum(counts) for counts in zip(*(stats['histogram'] for stats in endpoints))]
+        elapsed = time.monotonic() - self.started
+        return (f'Requests: {requests_count}, {requests_count / elapsed:.1f} req/s, '
+                f'p50<={self.percentile(histogram, 50)} ms, p90<={self.percentile(histogram, 90)} ms, '
+                f'p99<={self.percentile(histogram, 99)} ms')
+
+    def report(self):
+        lines = []
+        for name, stats in sorted(self.snapshot().items(), key=lambda item: -item[1]['requests']):
+            lines.append(f'{name}: {stats["requests"]} requests, {stats["errors"]} errors, '
+                         f'{stats["retries"]} retries, avg {stats["total_ms"] / stats["requests"]:.0f} ms, '
+                         f'p50<={self.percentile(stats["histogram"], 50)} ms, '
+                         f'p99<={self.percentile(stats["histogram"], 99)} ms')
+        return '\n'.join(lines)
+
+
+STATS = ApiStats()
+
+
+class ApiSession(requests.Session):
+    #http сессия с пулом соединений, gzip, размером страницы и повторами
+    #attempt() - одна попытка запроса, наследники могут обернуть ее (например ограничением нагрузки)
+
+    def __init__(self, pool_size=32, page_size=None, retries=3, backoff=0.5, verify=True, stats=STATS):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.verify = verify
+        self.page_size = page_size
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = stats
+
+    def attempt(self, method, url, **kwargs):
+        start = time.monotonic()
+        status = None
+        try:
+            response = super().request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.stats.record(method, url, status, time.monotonic() - start)
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+        if self.page_size and method == 'GET':
+            params = dict(kwargs.get('params') or {})
+            if 'limit' not in params and 'limit=' not in url:
+                params['limit'] = self.page_size
+                kwargs['params'] = params
+        attempt = 0
+        while True:
+            try:
+                response = self.attempt(method, url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                if method not in IDEMPOTENT_METHODS or attempt >= self.retries:
+                    raise
+                response = None
+            if response is not None:
+                #429 - запрос не обработан, его можно повторить любым методом; 5xx - только идемпотентные
+                retry = response.status_code == 429 or (response.status_code in RETRY_STATUSES
+                                                        and method in IDEMPOTENT_METHODS)
+                if not retry or attempt >= self.retries:
+                    return response
+            self.stats.retried(method, url)
+            delay = self.backoff * 2 ** attempt
+            if response is not None and response.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, int(response.headers['Retry-After']))
+            time.sleep(delay)
+            attempt += 1
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def cached_client(key, build):
+    #клиент один на процесс (pid в ключе: после fork в ProcessPoolExecutor соединения родителя не используем)
+    key = (os.getpid(),) + key
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = build()
+        return client
+
+
+def netbox(url, token, private_key_file=None, session=None, pool_size=32, page_size=None, verify=True):
+    #клиент pynetbox; с private_key_file ключ сессии secretstore получается один раз при создании клиента
+    #session - своя ApiSession (тогда клиент не кэшируется)
+    import pynetbox
+
+    def build():
+        if private_key_file:
+            api = pynetbox.api(url, token=token, private_key_file=private_key_file)
+        else:
+            api = pynetbox.api(url, token=token)
+        api.http_session = session or ApiSession(pool_size=pool_size, page_size=page_size, verify=verify)
+        return api
+
+    if session is not None:
+        return build()
+    return cached_client(('netbox', url, token, private_key_file, pool_size, page_size, verify), build)
+
+
+def nautobot(url, token, session=None, pool_size=32, page_size=None, verify=True):
+    #клиент pynautobot, устроен так же, как netbox()
+    import pynautobot
+
+    def build():
+        api = pynautobot.api(url, token=token, verify=verify)
+        api.http_session = session or ApiSession(pool_size=pool_size, page_size=page_size, verify=verify)
+        return api
+
+    if session is not None:
+        return build()
+    return cached_client(('nautobot', url, token, pool_size, page_size, verify), build)
+
+
+def report():
+    #сводка по всем запросам процесса, для печати в конце работы скрипта
+    return STATS.summary() + '\n' + STATS.report()
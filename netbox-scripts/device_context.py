@@ -0,0 +1,98 @@
+#данные для подключения к железкам из нетбокса: сама железка, ее primary ip, vlan группа и логопасс из secretstore
+#раньше каждый воркер на каждую железку делал devices.get + secrets.get (а secretstore на каждый клиент - обмен
+#ключом сессии по приватному ключу). здесь все это забирается пачкой на весь список железок несколькими запросами,
+#через один клиент api_client (ключ сессии secretstore получен один раз при его создании),
+#и хранится в памяти с ttl - воркеры получают данные железки обращением к словарю
+#
+# contexts = DeviceContextResolver(nb)
+# contexts.prefetch(['sw1', 'sw2'])
+#для железок без vlan групп (например вцентров): DeviceContextResolver(nb, vlan_groups=False)
+# ctx = contexts.get('sw1')  ->  ctx.host, ctx.username, ctx.password, ctx.device, ctx.vlan_group
+
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+
+#сколько имен передавать в одном фильтре (ограничение на длину url)
+FILTER_CHUNK = 100
+
+
+class DeviceContext(NamedTuple):
+    name: str
+    #объект железки из нетбокса
+    device: Any
+    #primary ip без маски
+    host: Optional[str]
+    #vlan группа с тем же именем, что и железка (None, если ее нет)
+    vlan_group: Any
+    username: Optional[str]
+    password: Optional[str]
+
+
+def primary_host(nb_device):
+    primary_ip = getattr(nb_device, 'primary_ip', None)
+    return str(primary_ip).split('/')[0] if primary_ip else None
+
+
+class DeviceContextResolver(object):
+    #кэш общий для всех потоков, записи живут ttl секунд
+    #vlan_groups=False - vlan группы не запрашиваются (у таких железок vlan_group всегда None)
+
+    def __init__(self, nb, ttl=300, vlan_groups=True):
+        self.nb = nb
+        self.ttl = ttl
+        self.vlan_groups = vlan_groups
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def filter_chunks(self, endpoint, field, names):
+        for start in range(0, len(names), FILTER_CHUNK):
+            for record in endpoint.filter(**{field: names[start:start + FILTER_CHUNK]}):
+                yield record
+
+    def prefetch(self, names, vlan_groups=None):
+        #данные всех железок списка: по одному постраничному запросу на железки, vlan группы и секреты
+        #vlan_groups=None - как задано в конструкторе
+        if vlan_groups is None:
+            vlan_groups = self.vlan_groups
+        names = [str(name) for name in dict.fromkeys(names)]
+        devices = {str(device.name): device for device in self.filter_chunks(self.nb.dcim.devices, 'name', names)}
+        groups = {}
+        if vlan_groups:
+            groups = {str(group.name): group for group in self.filter_chunks(self.nb.ipam.vlan_groups, 'name', names)}
+        secrets = {}
+        for secret in self.filter_chunks(self.nb.plugins.netbox_secretstore.secrets, 'device', names):
+            #в разных версиях плагина секрет привязан через assigned_object или через device
+            owner = getattr(secret, 'assigned_object', None) or getattr(secret, 'device', None)
+            device_name = str(getattr(owner, 'name', '') or '')
+            #если на железке несколько секретов, берем первый, как и secrets.get
+            secrets.setdefault(device_name, secret)
+        expires = time.time() + self.ttl
+        contexts = {}
+        for name in names:
+            secret = secrets.get(name)
+            contexts[name] = DeviceContext(
+                name=name,
+                device=devices.get(name),
+                host=primary_host(devices.get(name)),
+                vlan_group=groups.get(name),
+                username=secret.name if secret is not None else None,
+                password=secret.plaintext if secret is not None else None,
+            )
+        with self.lock:
+            for name, context in contexts.items():
+                self.cache[name] = (expires, context)
+        return contexts
+
+    def get(self, name):
+        #данные одной железки; если их нет в кэше или они устарели - дозапрашиваем только эту железку
+        name = str(name)
+        with self.lock:
+            cached = self.cache.get(name)
+        if cached is not None and cached[0] > time.time():
+            context = cached[1]
+        else:
+            context = self.prefetch([name])[name]
+        if context.device is None:
+            raise LookupError('Device {} not found in NetBox'.format(name))
+        return context